@@ -0,0 +1,141 @@
+# admission.py
+"""
+过载保护：按阶段（检索 / 重排 / 生成）统计在途请求，负载升高时逐级降级。
+
+检索槽位占用率决定降级档位：
+    0  正常
+    1  跳过 llm_rerank，/search 只返回混合检索结果
+    2  /ask 不再调用 DeepSeek，改用（放宽阈值的）缓存答案或纯检索摘录
+    3  检索槽位已满且等待超时 -> 503 + Retry-After
+
+重排与生成另有各自的并发上限，即使档位正常，上限打满时也会按同样方式降级。
+上限默认取对应档位的检索在途数（16 路检索时重排 8、生成 12），与档位保持一致；
+占用时最多排队 STAGE_WAIT 秒，吸收瞬时尖峰而不是立即降级。
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+from metrics import Counter, Gauge
+
+# 检索槽位占用率达到该比例时进入对应档位
+DEGRADE_RERANK_AT = 0.5
+DEGRADE_GENERATION_AT = 0.75
+
+# 各阶段最大并发数
+_MAX_RETRIEVAL = int(os.getenv("CAMPUS_MAX_RETRIEVAL", "16"))
+STAGE_LIMITS = {
+    "retrieval": _MAX_RETRIEVAL,
+    "rerank": int(os.getenv("CAMPUS_MAX_RERANK", str(int(_MAX_RETRIEVAL * DEGRADE_RERANK_AT)))),
+    "generation": int(os.getenv("CAMPUS_MAX_GENERATION", str(int(_MAX_RETRIEVAL * DEGRADE_GENERATION_AT)))),
+    "batch": int(os.getenv("CAMPUS_MAX_BATCH", "2")),      # /search/batch 同时进行的批量任务数
+}
+# 检索槽位满时的最长排队时间（秒），超时即拒绝
+RETRIEVAL_WAIT = float(os.getenv("CAMPUS_RETRIEVAL_WAIT", "0.5"))
+# 重排 / 生成槽位满时的最长排队时间（秒），超时即降级
+STAGE_WAIT = float(os.getenv("CAMPUS_STAGE_WAIT", "0.2"))
+RETRY_AFTER = 2
+
+LEVEL_NORMAL = 0
+LEVEL_NO_RERANK = 1
+LEVEL_NO_GENERATION = 2
+LEVEL_SHED = 3
+
+ADMISSION_INFLIGHT = Gauge("campus_admission_inflight", "各阶段已准入的在途请求数", ["stage"])
+ADMISSION_EVENTS = Counter("campus_admission_events_total", "准入结果（admitted / rejected）", ["stage", "result"])
+DEGRADED_RESPONSES = Counter("campus_degraded_responses_total", "降级响应次数", ["mode"])
+
+
+class Overloaded(Exception):
+    """检索槽位已满，请求应以 503 拒绝"""
+
+
+class AdmissionController:
+    def __init__(self, limits=None):
+        self.limits = dict(limits or STAGE_LIMITS)
+        # 各阶段各用一个 Condition（共享同一把锁）：释放某阶段的槽位只唤醒排队等该阶段的请求
+        self._lock = threading.Lock()
+        self._conds = {s: threading.Condition(self._lock) for s in self.limits}
+        self._inflight = {s: 0 for s in self.limits}
+
+    def inflight(self, stage: str) -> int:
+        with self._lock:
+            return self._inflight[stage]
+
+    def level(self) -> int:
+        """按检索槽位占用率给出当前降级档位"""
+        with self._lock:
+            usage = self._inflight["retrieval"] / self.limits["retrieval"]
+        if usage >= 1.0:
+            return LEVEL_SHED
+        if usage >= DEGRADE_GENERATION_AT:
+            return LEVEL_NO_GENERATION
+        if usage >= DEGRADE_RERANK_AT:
+            return LEVEL_NO_RERANK
+        return LEVEL_NORMAL
+
+    def acquire(self, stage: str, wait: float = 0.0) -> bool:
+        """占用一个槽位，成功后须调用 release；流式响应等无法用 with 包住的场景使用"""
+        cond = self._conds[stage]
+        with cond:
+            ok = cond.wait_for(lambda: self._inflight[stage] < self.limits[stage], timeout=wait)
+            if ok:
+                self._inflight[stage] += 1
+        ADMISSION_EVENTS.inc(stage=stage, result="admitted" if ok else "rejected")
+        if ok:
+            ADMISSION_INFLIGHT.inc(stage=stage)
+        return ok
+
+    def release(self, stage: str):
+        cond = self._conds[stage]
+        with cond:
+            self._inflight[stage] -= 1
+            cond.notify()
+        ADMISSION_INFLIGHT.dec(stage=stage)
+
+    def acquire_batch(self) -> bool:
+        """
+        /search/batch 占用一个批量槽位和一个检索槽位：批量任务同样压在检索路径上，
+        计入检索占用率后在线请求的降级档位才能反映它。成功后须调用 release_batch。
+        """
+        if not self.acquire("batch"):
+            return False
+        if not self.acquire("retrieval", RETRIEVAL_WAIT):
+            self.release("batch")
+            return False
+        return True
+
+    def release_batch(self):
+        self.release("retrieval")
+        self.release("batch")
+
+    @contextmanager
+    def slot(self, stage: str, wait: float = 0.0, enabled: bool = True):
+        """
+        尝试占用一个阶段槽位，yield 是否成功；enabled=False 时直接 yield False。
+        调用方根据结果决定正常执行还是降级。
+        """
+        ok = enabled and self.acquire(stage, wait)
+        try:
+            yield ok
+        finally:
+            if ok:
+                self.release(stage)
+
+    @contextmanager
+    def admit(self):
+        """占用检索槽位（必要时短暂排队），满载时抛出 Overloaded；yield 进入时的降级档位"""
+        level = self.level()
+        with self.slot("retrieval", wait=RETRIEVAL_WAIT) as ok:
+            if not ok:
+                DEGRADED_RESPONSES.inc(mode="shed")
+                raise Overloaded()
+            yield level
+
+    def stats(self):
+        with self._lock:
+            inflight = dict(self._inflight)
+        return {"level": self.level(), "inflight": inflight, "limits": dict(self.limits)}
+
+
+ADMISSION = AdmissionController()
@@ -0,0 +1,246 @@
+# answer_cache.py
+"""
+/ask 的语义答案缓存。
+
+用已加载的 BGE 模型给问题编码，在一个小型 FAISS 索引里找最相近的历史问题：
+余弦相似度超过阈值、且本次检索到的支撑文档与当时一致，就直接复用答案，
+省掉一次完整的 DeepSeek 调用。按 LRU 容量与 TTL 淘汰，索引重建后整体失效。
+
+阈值标定：python answer_cache.py --calibrate [--pairs pairs.jsonl]
+对同义问法（应命中）与不同问题（不应命中）统计各文档重合度阈值下的命中率。
+"""
+import os
+import json
+import time
+import argparse
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import faiss
+import numpy as np
+
+from bm_search import INDEX_DIR as BM25_INDEX_DIR
+from dense_search import FAISS_INDEX_PATH, load_model
+from dense_shards import SHARDS_SUBDIR, MANIFEST_FILE
+from metrics import CACHE_EVENTS
+
+CACHE_SIM_THRESHOLD = 0.92      # 问题向量余弦相似度阈值
+# 支撑文档集合的 Jaccard 相似度下限。默认 1.0：支撑文档完全不变才复用，保证答案依据的就是本次检索到的文档。
+# 可用 CAMPUS_CACHE_DOC_OVERLAP 放宽（5 篇文档时 0.6 等价于至少 4 篇相同），放宽前先用 --calibrate 在真实索引上标定
+CACHE_DOC_OVERLAP = float(os.getenv("CAMPUS_CACHE_DOC_OVERLAP", "1.0"))
+CACHE_MAX_ENTRIES = 1000
+CACHE_TTL = 24 * 3600           # 秒
+# 过载降级时（不再调用 DeepSeek）放宽的匹配条件，宁可复用相近问题的答案
+DEGRADED_SIM_THRESHOLD = 0.85
+DEGRADED_DOC_OVERLAP = 0.4       # 5 篇中至少 3 篇相同
+
+# 标定用的同义问法；不同问题的负例由错位配对生成
+CALIBRATION_PAIRS = [
+    ("人工智能专业的培养方案是什么？", "人工智能专业怎么培养学生？"),
+    ("图书馆几点开门？", "图书馆的开放时间是什么时候？"),
+    ("国家奖学金怎么申请？", "申请国家奖学金需要哪些材料？"),
+    ("校园卡丢了怎么办？", "校园卡丢失后如何补办？"),
+    ("本科生怎么选课？", "本科选课的流程是什么？"),
+    ("研究生学位论文答辩有什么要求？", "研究生论文答辩需要满足哪些条件？"),
+    ("高瓴人工智能学院在哪里？", "高瓴人工智能学院的地址是什么？"),
+    ("转专业需要什么条件？", "本科生转专业有哪些要求？"),
+]
+CALIBRATION_OVERLAPS = (1.0, 0.8, 0.6, 0.4)
+
+logger = logging.getLogger(__name__)
+
+
+def index_version():
+    """用稠密索引文件与 BM25 索引目录的修改时间作为版本号，重建索引后自动变化"""
+    version = []
+    shards_manifest = os.path.join(os.path.dirname(FAISS_INDEX_PATH), SHARDS_SUBDIR, MANIFEST_FILE)
+    for path in (FAISS_INDEX_PATH, shards_manifest, BM25_INDEX_DIR):
+        try:
+            version.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+class SemanticAnswerCache:
+    def __init__(self, dim: int, threshold: float = CACHE_SIM_THRESHOLD,
+                 doc_overlap: float = CACHE_DOC_OVERLAP,
+                 max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL):
+        self.dim = dim
+        self.threshold = threshold
+        self.doc_overlap = doc_overlap
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        self._entries = OrderedDict()   # id -> entry，按最近使用排序（LRU）
+        self._next_id = 0
+        self._version = index_version()
+
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    # ---------- 内部工具 ----------
+    def _remove(self, ids):
+        if not ids:
+            return
+        self._index.remove_ids(np.asarray(ids, dtype=np.int64))
+        for i in ids:
+            self._entries.pop(i, None)
+
+    def _check_version(self):
+        version = index_version()
+        if version != self._version:
+            logger.info("♻️ [AnswerCache] 检测到索引重建，清空答案缓存")
+            self._index.reset()
+            self._entries.clear()
+            self._version = version
+
+    def _expire(self, now):
+        expired = [i for i, e in self._entries.items() if now - e["created"] > self.ttl]
+        self._remove(expired)
+
+    def _docs_match(self, cached_docs, doc_ids, doc_overlap):
+        a, b = set(cached_docs), set(doc_ids)
+        if not a and not b:
+            return True
+        return len(a & b) / len(a | b) >= doc_overlap
+
+    # ---------- 对外接口 ----------
+    def lookup(self, q_emb, doc_ids, threshold=None, doc_overlap=None):
+        """
+        :param q_emb: 归一化后的问题向量，形状 (1, dim)
+        :param doc_ids: 本次检索得到的支撑文档 docid 列表
+        :param threshold / doc_overlap: 覆盖默认匹配条件（过载降级时放宽）
+        :return: 命中的缓存条目 dict，未命中返回 None
+        """
+        threshold = self.threshold if threshold is None else threshold
+        doc_overlap = self.doc_overlap if doc_overlap is None else doc_overlap
+        with self._lock:
+            self._check_version()
+            self._expire(time.time())
+            if self._index.ntotal == 0:
+                self.misses += 1
+                CACHE_EVENTS.inc(cache="answer", result="miss")
+                return None
+
+            sims, ids = self._index.search(q_emb, min(5, self._index.ntotal))
+            for sim, i in zip(sims[0], ids[0]):
+                if i < 0 or sim < threshold:
+                    break
+                entry = self._entries.get(int(i))
+                if entry and self._docs_match(entry["doc_ids"], doc_ids, doc_overlap):
+                    self._entries.move_to_end(int(i))
+                    entry["hits"] += 1
+                    self.hits += 1
+                    self.saved_seconds += entry["latency"]
+                    CACHE_EVENTS.inc(cache="answer", result="hit")
+                    return {**entry, "similarity": float(sim)}
+
+            self.misses += 1
+            CACHE_EVENTS.inc(cache="answer", result="miss")
+            return None
+
+    def put(self, query, q_emb, doc_ids, answer, latency):
+        """写入一条答案；latency 为生成这条答案所花的秒数，用于统计命中后节省的时间"""
+        with self._lock:
+            self._check_version()
+            while len(self._entries) >= self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove([oldest])
+
+            i = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(q_emb, np.asarray([i], dtype=np.int64))
+            self._entries[i] = {
+                "query": query,
+                "doc_ids": tuple(doc_ids),
+                "answer": answer,
+                "latency": latency,
+                "created": time.time(),
+                "hits": 0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._index.reset()
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3),
+            }
+
+
+@lru_cache(maxsize=1)
+def get_answer_cache() -> SemanticAnswerCache:
+    return SemanticAnswerCache(load_model().get_sentence_embedding_dimension())
+
+
+# ========== 阈值标定 ==========
+def _jaccard(a, b):
+    a, b = set(a), set(b)
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def calibrate(pairs, top_k=5, sim_threshold=CACHE_SIM_THRESHOLD, overlaps=CALIBRATION_OVERLAPS):
+    """
+    在当前索引上测量：同义问法的命中率（越高越好）与不同问题的误命中率（应为 0）。
+    支撑文档与 rag_qa 一致，取混合检索 top_k 中有正文的文档。
+    """
+    from dense_search import encode_query
+    from hybrid_search import hybrid_search
+
+    def docs_of(q):
+        return [h["docid"] for h in hybrid_search(q, top_k=top_k) if h["contents"]]
+
+    def measure(qa, qb):
+        sim = float((encode_query(qa) * encode_query(qb)).sum())
+        return sim, _jaccard(docs_of(qa), docs_of(qb))
+
+    positives = [measure(a, b) for a, b in pairs]
+    negatives = [measure(pairs[i][0], pairs[(i + 1) % len(pairs)][1]) for i in range(len(pairs))]
+
+    rows = []
+    for t in overlaps:
+        hit = lambda m: m[0] >= sim_threshold and m[1] >= t
+        rows.append({
+            "doc_overlap": t,
+            "paraphrase_hit_rate": round(sum(map(hit, positives)) / len(positives), 3),
+            "false_hit_rate": round(sum(map(hit, negatives)) / len(negatives), 3),
+        })
+    return {
+        "pairs": len(pairs),
+        "sim_threshold": sim_threshold,
+        "paraphrase_mean_sim": round(float(np.mean([m[0] for m in positives])), 4),
+        "paraphrase_mean_jaccard": round(float(np.mean([m[1] for m in positives])), 4),
+        "thresholds": rows,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="语义答案缓存：匹配阈值标定")
+    parser.add_argument("--calibrate", action="store_true")
+    parser.add_argument("--pairs", help='JSONL，每行 {"q1": "...", "q2": "..."} 为一对同义问法；默认使用内置样例')
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.calibrate:
+        if args.pairs:
+            with open(args.pairs, "r", encoding="utf-8") as f:
+                pairs = [(o["q1"], o["q2"]) for o in map(json.loads, filter(str.strip, f))]
+        else:
+            pairs = CALIBRATION_PAIRS
+        print(json.dumps(calibrate(pairs, args.top_k), ensure_ascii=False, indent=2))
+    else:
+        parser.print_help()
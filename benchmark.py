@@ -0,0 +1,444 @@
+# benchmark.py
+"""
+离线检索评测 / 回归基准。
+
+回放一个查询文件，分别评测各检索组件与完整流程：
+- 效果：recall@k / nDCG@k / MRR（查询带相关性标注时）
+- 性能：延迟分位数、吞吐 (QPS)、峰值内存
+结果写成 JSON 报告，可与上一次的报告对比，效果下降超过容忍度时返回非零退出码。
+
+查询文件为 JSONL，每行形如：
+    {"qid": "q1", "query": "人工智能 培养方案", "relevant": {"doc12": 2, "doc40": 1}}
+其中 qid / relevant 可省略（relevant 也可以是 docid 列表）；.txt 文件则每行一个查询。
+
+用法：
+    python benchmark.py --fixture                         # 合成小语料 + 小索引，完全离线
+    python benchmark.py --queries queries.jsonl --k 10     # 对当前目录下的真实索引
+    python benchmark.py --fixture --baseline last.json     # 与上次报告对比，回归则失败
+"""
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+os.environ["OMP_NUM_THREADS"] = "1"
+
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+QUALITY_METRICS = ("recall", "ndcg", "mrr")
+DEFAULT_COMPONENTS = "bm25,dense,hybrid,pipeline"
+
+
+# ========== 离线小语料 (fixture) ==========
+FIXTURE_TOPICS = [
+    ("人工智能学院", ["高瓴人工智能学院", "人工智能专业", "机器学习", "培养方案", "深度学习课程"]),
+    ("图书馆", ["图书馆", "图书借阅", "开放时间", "自习室预约", "电子资源"]),
+    ("本科招生", ["招生简章", "录取分数线", "报考指南", "强基计划", "招生咨询"]),
+    ("奖学金", ["国家奖学金", "评选办法", "助学金", "申请材料", "学生资助"]),
+    ("就业指导", ["校园招聘", "实习基地", "就业率", "职业发展", "签约手续"]),
+    ("后勤服务", ["学生食堂", "学生宿舍", "校园卡", "物业报修", "校医院"]),
+    ("研究生院", ["硕士研究生", "博士研究生", "学位论文", "导师名录", "推免生"]),
+    ("国际交流", ["出国留学", "交换生项目", "国际合作", "海外学习", "外事处"]),
+]
+FIXTURE_FILLERS = [
+    "本页面介绍了相关工作的具体安排", "请各位同学及时关注通知", "详细内容见附件",
+    "如有疑问请联系相关老师", "相关工作按照学校统一部署进行", "欢迎广大师生积极参与",
+    "现将有关事项通知如下", "本通知自发布之日起执行",
+]
+FIXTURE_NAV = "首页 学院概况 新闻中心 通知公告 人才培养 科学研究 联系我们"
+FIXTURE_FOOTER = "版权所有 中国人民大学 地址：北京市海淀区中关村大街59号 邮编：100872"
+
+
+class HashingEncoder:
+    """
+    离线用的确定性编码器：字符一元 / 二元组哈希到固定维度后归一化。
+    接口与 SentenceTransformer 的 encode / get_sentence_embedding_dimension 一致，
+    只用于 fixture，不代表真实模型效果。
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def _vec(self, text):
+        v = np.zeros(self.dim, dtype=np.float32)
+        grams = list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+        for g in grams:
+            if g.isspace():
+                continue
+            h = int.from_bytes(hashlib.md5(g.encode("utf-8")).digest()[:4], "little")
+            v[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        return v
+
+    def encode(self, texts, normalize_embeddings=True, **kwargs):
+        embs = np.vstack([self._vec(t) for t in texts])
+        if normalize_embeddings:
+            embs /= np.maximum(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12)
+        return embs
+
+
+def make_fixture_corpus(n_docs: int = 240, seed: int = 42):
+    """生成带导航/页脚样板文字的合成网页，以及带分级相关性标注的查询"""
+    rng = random.Random(seed)
+    docs = []
+    for i in range(n_docs):
+        topic, terms = FIXTURE_TOPICS[i % len(FIXTURE_TOPICS)]
+        main_term = terms[(i // len(FIXTURE_TOPICS)) % len(terms)]
+        sentences = [f"{topic} {main_term}"]
+        for _ in range(rng.randint(10, 24)):
+            sentences.append(f"{rng.choice(terms)}，{rng.choice(FIXTURE_FILLERS)}。")
+        contents = " ".join([FIXTURE_NAV] + sentences + [FIXTURE_FOOTER])
+        docs.append({
+            "id": f"doc{i + 1}",
+            "url": f"http://fixture.ruc.edu.cn/t{i % len(FIXTURE_TOPICS)}/{i + 1}.htm",
+            "contents": contents,
+            "topic": topic,
+            "main_term": main_term,
+        })
+
+    queries = []
+    for t, (topic, terms) in enumerate(FIXTURE_TOPICS):
+        for term in terms[:3]:
+            relevant = {}
+            for d in docs:
+                if d["topic"] == topic:
+                    relevant[d["id"]] = 2 if d["main_term"] == term else 1
+            queries.append({"qid": f"t{t}_{term}", "query": f"{topic} {term}", "relevant": relevant})
+    return docs, queries
+
+
+def build_fixture(root: str, encoder):
+    """在 root 下生成 corpus_dir / dense_index / bm_index 三个目录"""
+    from build_dense_index import build_dense_index
+
+    docs, queries = make_fixture_corpus()
+    corpus_dir = os.path.join(root, "corpus_dir")
+    os.makedirs(corpus_dir, exist_ok=True)
+    with open(os.path.join(corpus_dir, "corpus.jsonl"), "w", encoding="utf-8") as f:
+        for d in docs:
+            f.write(json.dumps({k: d[k] for k in ("id", "url", "contents")}, ensure_ascii=False) + "\n")
+
+    build_dense_index(
+        corpus_dir=corpus_dir,
+        output_index=os.path.join(root, "dense_index", "dense.index"),
+        output_ids=os.path.join(root, "dense_index", "docids.json"),
+        model=encoder,
+    )
+
+    # 与 README 中的 BM25 建索引命令一致
+    subprocess.run([
+        sys.executable, "-m", "pyserini.index.lucene",
+        "--collection", "JsonCollection",
+        "--input", corpus_dir,
+        "--index", os.path.join(root, "bm_index"),
+        "--generator", "DefaultLuceneDocumentGenerator",
+        "--threads", "1",
+        "--storePositions", "--storeDocvectors", "--storeRaw",
+    ], check=True, stdout=subprocess.DEVNULL)
+    return queries
+
+
+def use_index_root(root: str, encoder=None):
+    """把各检索模块指向 root 下的索引，并清空已缓存的加载结果"""
+    import bm_search
+    import dense_search
+    import fusion
+
+    bm_search.INDEX_DIR = os.path.join(root, "bm_index")
+    dense_search.FAISS_INDEX_PATH = os.path.join(root, "dense_index", "dense.index")
+    dense_search.ID_MAPPING_PATH = os.path.join(root, "dense_index", "docids.json")
+    dense_search.CORPUS_PATH = os.path.join(root, "corpus_dir", "corpus.jsonl")
+    fusion.DOC_TABLE_DIR = os.path.join(root, "dense_index")
+    if encoder is not None:
+        dense_search.load_model = lambda: encoder
+
+    for fn in (bm_search.get_searcher, dense_search.load_corpus, dense_search.load_dense_index,
+               dense_search.encode_query, fusion.load_doc_table):
+        fn.cache_clear()
+
+
+# ========== 查询文件 ==========
+def load_queries(path: str):
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                obj = json.loads(line)
+            else:
+                obj = {"query": line}
+            rel = obj.get("relevant") or {}
+            if isinstance(rel, list):
+                rel = {d: 1 for d in rel}
+            queries.append({"qid": obj.get("qid", f"q{i + 1}"), "query": obj["query"], "relevant": rel})
+    return queries
+
+
+# ========== 评测指标 ==========
+def recall_at_k(ranked, rel, k):
+    """按 min(相关文档数, k) 归一化：相关文档多于 k 篇时，前 k 条全部相关即为 1.0"""
+    n_rel = min(sum(1 for g in rel.values() if g > 0), k)
+    return sum(1 for d in ranked[:k] if rel.get(d, 0) > 0) / n_rel if n_rel else 0.0
+
+
+def ndcg_at_k(ranked, rel, k):
+    dcg = sum((2 ** rel.get(d, 0) - 1) / math.log2(i + 2) for i, d in enumerate(ranked[:k]))
+    ideal = sorted((g for g in rel.values() if g > 0), reverse=True)[:k]
+    idcg = sum((2 ** g - 1) / math.log2(i + 2) for i, g in enumerate(ideal))
+    return dcg / idcg if idcg else 0.0
+
+
+def mrr(ranked, rel):
+    for i, d in enumerate(ranked):
+        if rel.get(d, 0) > 0:
+            return 1.0 / (i + 1)
+    return 0.0
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:   # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 单位是字节，Linux 是 KB
+    return round(rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024, 1)
+
+
+# ========== 各组件 ==========
+def get_components(names, k, token_budget, with_llm):
+    """返回 {名称: fn(query) -> 排好序的 docid 列表}"""
+    from bm_search import bm25_docids
+    from dense_search import dense_chunk_search
+    from fusion import load_doc_table
+    from hybrid_search import hybrid_search
+    from passages import pack_passages
+
+    def dense_docs(q):
+        idxs, _ = dense_chunk_search(q, n_docs=k)
+        table = load_doc_table()
+        docs = table.chunk_doc[idxs]
+        _, first = np.unique(docs, return_index=True)
+        return [table.doc_ids[d] for d in docs[np.sort(first)][:k]]
+
+    def pipeline(q):
+        # 完整检索流程直到发给 LLM 之前：混合检索 + 段落打包，返回真正进入提示词的文档
+        packed, _ = pack_passages(hybrid_search(q, top_k=k, with_passages=True), token_budget)
+        return [d["docid"] for d, _ in packed]
+
+    available = {
+        "bm25": lambda q: bm25_docids(q, k),
+        "dense": dense_docs,
+        "hybrid": lambda q: [h["docid"] for h in hybrid_search(q, top_k=k)],
+        "pipeline": pipeline,
+    }
+    if with_llm:
+        from llm_rerank import llm_rerank
+        available["rerank"] = lambda q: [r["docid"] for r in llm_rerank(q, top_k_candidate=20, top_k_final=k)]
+
+    unknown = [n for n in names if n not in available]
+    if unknown:
+        raise SystemExit(f"❌ 未知组件: {unknown}，可选: {list(available)}")
+    return {n: available[n] for n in names}
+
+
+def run_component(fn, queries, k, measure_memory=True):
+    from dense_search import encode_query
+
+    fn(queries[0]["query"])   # 预热，排除首次加载模型/索引的开销
+    # 查询向量有 lru_cache，前面的组件与预热都会填充它；每轮计时前清空，确保包含编码开销
+    encode_query.cache_clear()
+
+    latencies, rankings = [], []
+    wall_start = time.perf_counter()
+    for q in queries:
+        start = time.perf_counter()
+        rankings.append(fn(q["query"]))
+        latencies.append((time.perf_counter() - start) * 1000)
+    wall = time.perf_counter() - wall_start
+
+    lat = np.asarray(latencies)
+    result = {
+        "latency_ms": {
+            "mean": round(float(lat.mean()), 3),
+            "p50": round(float(np.percentile(lat, 50)), 3),
+            "p90": round(float(np.percentile(lat, 90)), 3),
+            "p99": round(float(np.percentile(lat, 99)), 3),
+            "max": round(float(lat.max()), 3),
+        },
+        "qps": round(len(queries) / wall, 2) if wall > 0 else None,
+    }
+
+    labeled = [(q, r) for q, r in zip(queries, rankings) if q["relevant"]]
+    if labeled:
+        result["labeled_queries"] = len(labeled)
+        result["recall"] = round(float(np.mean([recall_at_k(r, q["relevant"], k) for q, r in labeled])), 4)
+        result["ndcg"] = round(float(np.mean([ndcg_at_k(r, q["relevant"], k) for q, r in labeled])), 4)
+        result["mrr"] = round(float(np.mean([mrr(r, q["relevant"]) for q, r in labeled])), 4)
+
+    if measure_memory:
+        # 单独跑一遍测 Python 堆峰值（tracemalloc 本身会拖慢速度，不与计时混在一起）
+        encode_query.cache_clear()
+        tracemalloc.start()
+        for q in queries:
+            fn(q["query"])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_traced_mb"] = round(peak / (1024 * 1024), 2)
+
+    return result
+
+
+def compare_batch_throughput(queries, k, batch_size=32):
+    """逐条循环 hybrid_search 与 hybrid_search_batch 的吞吐对比，并核对两者结果是否一致"""
+    from dense_search import encode_query
+    from hybrid_search import hybrid_search, hybrid_search_batch
+
+    texts = [q["query"] for q in queries]
+    hybrid_search(texts[0], top_k=k)   # 预热
+    encode_query.cache_clear()
+
+    start = time.perf_counter()
+    single = [[h["docid"] for h in hybrid_search(t, top_k=k)] for t in texts]
+    single_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = [None] * len(texts)
+    for i, hits in hybrid_search_batch(texts, top_k=k, batch_size=batch_size):
+        batch[i] = [h["docid"] for h in hits]
+    batch_s = time.perf_counter() - start
+
+    return {
+        "n_queries": len(texts),
+        "batch_size": batch_size,
+        "single_qps": round(len(texts) / single_s, 2),
+        "batch_qps": round(len(texts) / batch_s, 2),
+        "speedup": round(single_s / batch_s, 2),
+        "identical": single == batch,
+    }
+
+
+# ========== 报告对比 ==========
+def compare_reports(report, baseline, tolerance):
+    """打印与基线的差异，返回效果下降超过容忍度的项"""
+    regressions = []
+    print("\n📊 与基线对比：")
+    for name, cur in report["components"].items():
+        base = baseline.get("components", {}).get(name)
+        if not base:
+            print(f"  {name}: 基线中不存在，跳过")
+            continue
+        parts = []
+        for m in QUALITY_METRICS:
+            if m in cur and m in base:
+                delta = cur[m] - base[m]
+                parts.append(f"{m} {base[m]:.4f}->{cur[m]:.4f} ({delta:+.4f})")
+                if delta < -tolerance:
+                    regressions.append(f"{name}.{m}")
+        for p in ("p50", "p99"):
+            b, c = base["latency_ms"][p], cur["latency_ms"][p]
+            parts.append(f"{p} {b:.1f}->{c:.1f}ms")
+        print(f"  {name}: " + " | ".join(parts))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线检索评测与回归基准")
+    parser.add_argument("--queries", help="查询文件 (.jsonl 带标注 / .txt 每行一个查询)")
+    parser.add_argument("--fixture", action="store_true", help="使用合成小语料与小索引，完全离线运行")
+    parser.add_argument("--index-root", default=".", help="索引所在目录（含 corpus_dir / dense_index / bm_index）")
+    parser.add_argument("--components", default=DEFAULT_COMPONENTS, help="逗号分隔的组件列表")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--token-budget", type=int, default=1500, help="pipeline 组件的提示词 token 预算")
+    parser.add_argument("--llm", action="store_true", help="同时评测 DeepSeek 重排（需要网络与 API Key）")
+    parser.add_argument("--no-memory", action="store_true", help="跳过 tracemalloc 内存测量")
+    parser.add_argument("--batch", action="store_true", help="对比批量检索与逐条检索的吞吐")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--output", default="bench_report.json")
+    parser.add_argument("--baseline", help="上一次的报告，用于对比与回归判定")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="效果指标允许下降的幅度")
+    args = parser.parse_args()
+
+    if not args.queries and not args.fixture:
+        parser.error("需要 --queries 或 --fixture")
+
+    fixture_dir = None
+    try:
+        if args.fixture:
+            fixture_dir = tempfile.mkdtemp(prefix="campus_bench_")
+            encoder = HashingEncoder()
+            print(f"🧪 正在生成离线 fixture: {fixture_dir}")
+            fixture_queries = build_fixture(fixture_dir, encoder)
+            use_index_root(fixture_dir, encoder)
+        elif args.index_root != ".":
+            use_index_root(args.index_root)
+
+        queries = load_queries(args.queries) if args.queries else fixture_queries
+        if not queries:
+            raise SystemExit("❌ 查询文件为空")
+
+        names = [n.strip() for n in args.components.split(",") if n.strip()]
+        if args.llm and "rerank" not in names:
+            names.append("rerank")
+        components = get_components(names, args.k, args.token_budget, args.llm)
+
+        report = {
+            "meta": {
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "queries": args.queries or "fixture",
+                "n_queries": len(queries),
+                "k": args.k,
+                "fixture": args.fixture,
+            },
+            "components": {},
+        }
+        for name, fn in components.items():
+            print(f"⏱️ 评测 {name} ...")
+            report["components"][name] = run_component(fn, queries, args.k, not args.no_memory)
+        if args.batch:
+            print("⏱️ 评测批量检索 ...")
+            report["batch"] = compare_batch_throughput(queries, args.k, args.batch_size)
+        report["process"] = {"peak_rss_mb": peak_rss_mb()}
+    finally:
+        if fixture_dir:
+            shutil.rmtree(fixture_dir, ignore_errors=True)
+
+    print(f"\n{'组件':<10}{'recall':>8}{'ndcg':>8}{'p50(ms)':>10}{'p99(ms)':>10}{'QPS':>9}")
+    for name, r in report["components"].items():
+        print(f"{name:<10}{r.get('recall', float('nan')):>8.4f}{r.get('ndcg', float('nan')):>8.4f}"
+              f"{r['latency_ms']['p50']:>10.2f}{r['latency_ms']['p99']:>10.2f}{r['qps'] or 0:>9.1f}")
+
+    if "batch" in report:
+        b = report["batch"]
+        print(f"\n📦 批量检索: 逐条 {b['single_qps']} QPS -> 批量 {b['batch_qps']} QPS "
+              f"(x{b['speedup']}，batch_size={b['batch_size']}，结果一致: {b['identical']})")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+    print(f"\n📝 报告已写入 {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, args.tolerance)
+        if regressions:
+            print(f"❌ 效果回归: {regressions}")
+            sys.exit(1)
+        print("✅ 无效果回归")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
 # bm_search.py
 import json
+import logging
+from functools import lru_cache
 from pyserini.search.lucene import LuceneSearcher
 
 INDEX_DIR = "bm_index"
+# batch_search 使用的 Lucene 检索线程数
+BATCH_THREADS = 4
 
+logger = logging.getLogger(__name__)
+
+@lru_cache(maxsize=1)
 def get_searcher():
     searcher = LuceneSearcher(INDEX_DIR)
     searcher.set_language('zh')
@@ -40,13 +47,24 @@ def bm25_search(query: str, k: int = 10):
     return results
 """
 
+def bm25_docids(query: str, k: int = 10):
+    """只返回按 BM25 排好的 docid，不取回原文（融合阶段只需要排名）"""
+    hits = get_searcher().search(query, k)
+    return [hit.docid for hit in hits]
+
+def bm25_docids_batch(queries, k: int = 10, threads: int = BATCH_THREADS):
+    """批量版 bm25_docids：走 Pyserini batch_search，多个查询在 JVM 内并行检索"""
+    qids = [str(i) for i in range(len(queries))]
+    hits = get_searcher().batch_search(list(queries), qids, k=k, threads=threads)
+    return [[hit.docid for hit in hits.get(qid, [])] for qid in qids]
+
 def bm25_search(query: str, k: int = 10):
-    print(f"DEBUG: 正在搜索关键词: {query}")
+    logger.debug("正在搜索关键词: %s", query)
     searcher = get_searcher()
     
     # 关键点1：确认搜索是否真的找到了 id
     hits = searcher.search(query, k)
-    print(f"DEBUG: 搜索结果数量 (hits): {len(hits)}")
+    logger.debug("搜索结果数量 (hits): %d", len(hits))
 
     results = []
 
@@ -56,19 +74,19 @@ def bm25_search(query: str, k: int = 10):
         
         # 关键点2：确认是否能根据 id 取回文档内容
         if doc is None:
-            print(f"DEBUG: 第 {i+1} 条 (id={hit.docid}) -> 文档对象为 None (索引时可能未开启 storeContents)")
+            logger.debug("第 %d 条 (id=%s) -> 文档对象为 None (索引时可能未开启 storeContents)", i + 1, hit.docid)
             continue
             
         try:
             # 2. 获取原始字符串
             raw_str = doc.raw()
-            print(f"DEBUG: 第 {i+1} 条 -> 原始数据前50字: {raw_str[:50]}") # 看看是不是空的
+            logger.debug("第 %d 条 -> 原始数据前50字: %.50s", i + 1, raw_str) # 看看是不是空的
             
             # 3. 解析 JSON
             raw_json = json.loads(raw_str)
             
             # 关键点3：确认 JSON 里的字段名对不对
-            print(f"DEBUG: 第 {i+1} 条 -> JSON的所有键: {list(raw_json.keys())}")
+            logger.debug("第 %d 条 -> JSON的所有键: %s", i + 1, raw_json.keys())
             
             content = raw_json.get("contents", "")
             if not content:
@@ -83,9 +101,9 @@ def bm25_search(query: str, k: int = 10):
             })
             
         except Exception as e:
-            print(f"DEBUG: 解析出错: {e}")
+            logger.warning("解析出错 (id=%s): %s", hit.docid, e)
 
-    print(f"DEBUG: 最终返回结果数: {len(results)}")
+    logger.debug("最终返回结果数: %d", len(results))
     return results
 
 if __name__ == "__main__":
@@ -1,52 +1,54 @@
 # build_dense_index.py
 import os
 import json
+import time
+import hashlib
+
 import faiss
 import numpy as np
 from tqdm import tqdm
-from sentence_transformers import SentenceTransformer
+from encoder import load_encoder, encoder_backend
+from fusion import build_doc_table, save_doc_table, chunk_docid
+from passages import chunk_text, CHUNK_SIZE, CHUNK_OVERLAP
+from shared_index import export_shared_index
+from dense_shards import build_shards, SHARDS_SUBDIR
 
 # ========= 路径按你的目录结构设置 =========
 CORPUS_DIR = "/Users/cik-z/Desktop/智能信息检索导论/作业/final/corpus_dir"
 OUTPUT_INDEX = "/Users/cik-z/Desktop/智能信息检索导论/作业/final/dense_index/dense.index"
 OUTPUT_IDS = "/Users/cik-z/Desktop/智能信息检索导论/作业/final/dense_index/docids.json"
 
-CHUNK_SIZE = 300
-CHUNK_OVERLAP = 50
-
 MODEL_NAME = "BAAI/bge-small-zh-v1.5"
 
+# >0 时构建分片索引（各分片并行编码），0 表示构建单个整体索引
+N_SHARDS = 0
 
-def chunk_text(text, size=300, overlap=50):
-    """把文本切片成 chunk"""
-    text = text.strip()
-    chunks = []
-    start = 0
+# 同一段 chunk 文本出现在至少这么多篇不同文档里，视为导航栏/页脚/公告等样板文字，不进向量索引；0 表示不丢弃
+BOILERPLATE_MIN_DOCS = 20
+DEDUP_REPORT_FILE = "dedup_report.json"
 
-    while start < len(text):
-        end = min(start + size, len(text))
-        chunks.append(text[start:end])
-        start += size - overlap
 
-    return chunks
+def load_default_model():
+    print("加载 Embedding 模型：", MODEL_NAME, f"({encoder_backend()})")
+    return load_encoder(MODEL_NAME)
 
 
-def build_dense_index():
-    print("加载 Embedding 模型：", MODEL_NAME)
-    model = SentenceTransformer(MODEL_NAME)
-    emb_dim = model.get_sentence_embedding_dimension()
-    print("Embedding 维度：", emb_dim)
-
+def read_corpus_chunks(corpus_dir):
+    """
+    读取 corpus_dir 下所有 JSONL，切成 chunk。
+    :return: (texts, ids, docs)，docs 为整个语料的 docid -> {url, contents}
+    """
     print("\n开始读取 corpus_dir 下的 JSONL 文件...\n")
 
     texts = []
     ids = []
+    docs = {}       # 用于预计算 URL 分组与导出共享文档库
 
     # ===== 遍历 corpus_dir 下所有 jsonl 文件 =====
-    json_files = [f for f in os.listdir(CORPUS_DIR) if f.endswith(".jsonl")]
+    json_files = [f for f in os.listdir(corpus_dir) if f.endswith(".jsonl")]
 
     for fname in json_files:
-        path = os.path.join(CORPUS_DIR, fname)
+        path = os.path.join(corpus_dir, fname)
         print(f"读取文件：{path}")
 
         # 获取行数以显示进度条
@@ -57,6 +59,8 @@ def build_dense_index():
                 obj = json.loads(line)
                 docid = obj.get("id", "")
                 content = obj.get("contents", "")
+                if docid:
+                    docs[docid] = {"url": obj.get("url", ""), "contents": content}
 
                 if not content or not docid:
                     continue
@@ -67,34 +71,151 @@ def build_dense_index():
                     ids.append(f"{docid}_chunk{idx}")
 
     print(f"\n📌 总 chunk 数量：{len(texts)}\n")
+    return texts, ids, docs
+
+
+def chunk_key(text):
+    """chunk 去重用的哈希（忽略空白差异）"""
+    return hashlib.blake2b(" ".join(text.split()).encode("utf-8"), digest_size=16).digest()
+
+
+def drop_boilerplate(texts, ids, min_docs=BOILERPLATE_MIN_DOCS):
+    """
+    丢弃在 >= min_docs 篇文档中重复出现的 chunk（样板文字），BM25 仍能搜到这些页面。
+    同一文档的 chunk 在 ids 中是连续的，所以每个 key 只需记 [上一个 docid, 文档数]，不必存 docid 集合。
+    :return: (texts, ids, keys, stats)，keys 为保留下来的 chunk 的哈希，交给 encode_chunks 复用
+    """
+    keys = [chunk_key(t) for t in texts]
+    doc_count = {}
+    for key, cid in zip(keys, ids):
+        docid = chunk_docid(cid)
+        entry = doc_count.get(key)
+        if entry is None:
+            doc_count[key] = [docid, 1]
+        elif entry[0] != docid:
+            entry[0] = docid
+            entry[1] += 1
+    boilerplate = {k for k, (_, n) in doc_count.items() if min_docs and n >= min_docs}
+
+    keep = [i for i, key in enumerate(keys) if key not in boilerplate]
+    stats = {
+        "chunks": len(texts),
+        "unique_chunks": len(doc_count),
+        "boilerplate_patterns": len(boilerplate),
+        "boilerplate_chunks": len(texts) - len(keep),
+    }
+    return [texts[i] for i in keep], [ids[i] for i in keep], [keys[i] for i in keep], stats
+
+
+def encode_chunks(model, texts, batch_size=32, desc="Embedding 进度", dedup=True, keys=None):
+    """
+    对所有 chunks 编码向量；dedup=True 时相同文本只编码一次，重复的 chunk 复用同一个向量。
+    :param keys: 与 texts 一一对应的 chunk_key，drop_boilerplate 已算过时直接传入，避免重复哈希
+    """
+    if dedup:
+        if keys is None:
+            keys = [chunk_key(t) for t in texts]
+        first, unique = {}, []
+        inverse = np.empty(len(texts), dtype=np.int64)
+        for i, (text, key) in enumerate(zip(texts, keys)):
+            j = first.setdefault(key, len(unique))
+            if j == len(unique):
+                unique.append(text)
+            inverse[i] = j
+        if len(unique) < len(texts):
+            print(f"📌 去重后实际编码 {len(unique)}/{len(texts)} 个 chunk")
+        return encode_chunks(model, unique, batch_size, desc, dedup=False)[inverse]
 
-    # ===== 对所有 chunks 编码向量 =====
-    print("开始编码向量（embedding）...\n")
     embeddings = []
-
-    batch_size = 32
-    for i in tqdm(range(0, len(texts), batch_size), desc="Embedding 进度"):
+    for i in tqdm(range(0, len(texts), batch_size), desc=desc):
         batch = texts[i:i + batch_size]
         vecs = model.encode(batch, normalize_embeddings=True)
         embeddings.append(vecs)
 
-    embeddings = np.vstack(embeddings).astype("float32")
-
-    print("\n向量编码完成，开始构建 FAISS index...\n")
-
-    # ===== 构建 FAISS IndexFlatIP =====
-    index = faiss.IndexFlatIP(emb_dim)
-    index.add(embeddings)
+    return np.vstack(embeddings).astype("float32")
+
+
+def dedup_report(stats, indexed_chunks, encode_seconds, dim):
+    """
+    估算去重的收益：按实际编码速度折算省下的编码时间，按丢弃的向量数折算索引体积。
+    分片构建时各分片内部独立去重，这里按全局唯一数估算。
+    """
+    encoded = stats["unique_chunks"] - stats["boilerplate_patterns"]
+    saved = stats["chunks"] - encoded
+    per_chunk = encode_seconds / encoded if encoded else 0.0
+    return {
+        **stats,
+        "indexed_chunks": indexed_chunks,
+        "encoded_chunks": encoded,
+        "encodes_saved": saved,
+        "encode_seconds": round(encode_seconds, 2),
+        "encode_seconds_saved": round(per_chunk * saved, 2),
+        "index_mb_saved": round(stats["boilerplate_chunks"] * dim * 4 / 2 ** 20, 2),
+    }
+
+
+def build_dense_index(corpus_dir=CORPUS_DIR, output_index=OUTPUT_INDEX, output_ids=OUTPUT_IDS, model=None,
+                      n_shards=N_SHARDS, boilerplate_min_docs=BOILERPLATE_MIN_DOCS):
+    """
+    :param model: 可传入已加载的编码器（需提供 encode / get_sentence_embedding_dimension），
+                  默认加载 MODEL_NAME
+    :param n_shards: >0 时按 chunk 行号切成 n_shards 个分片，由多个进程并行编码构建（见 dense_shards.py）
+    :param boilerplate_min_docs: 样板 chunk 的文档频次阈值，见 BOILERPLATE_MIN_DOCS
+    """
+    output_dir = os.path.dirname(output_index)
+    texts, ids, docs = read_corpus_chunks(corpus_dir)
+    texts, ids, keys, dedup_stats = drop_boilerplate(texts, ids, boilerplate_min_docs)
+    print(f"📌 样板文字：{dedup_stats['boilerplate_patterns']} 种，共丢弃 {dedup_stats['boilerplate_chunks']} 个 chunk\n")
+    encode_start = time.perf_counter()
+
+    if n_shards > 0:
+        # ===== 分片并行构建：每个分片一个进程各自编码 =====
+        print(f"开始分片构建（{n_shards} 个分片并行编码）...\n")
+        shards_dir = os.path.join(output_dir, SHARDS_SUBDIR)
+        manifest = build_shards(texts, shards_dir, n_shards, model=model, keys=keys)
+        embeddings = None
+        dim = manifest["dim"]
+    else:
+        if model is None:
+            model = load_default_model()
+        dim = model.get_sentence_embedding_dimension()
+        print("Embedding 维度：", dim)
+
+        print("开始编码向量（embedding）...\n")
+        embeddings = encode_chunks(model, texts, keys=keys)
+
+        print("\n向量编码完成，开始构建 FAISS index...\n")
+
+        # ===== 构建 FAISS IndexFlatIP =====
+        index = faiss.IndexFlatIP(embeddings.shape[1])
+        index.add(embeddings)
+
+        os.makedirs(output_dir, exist_ok=True)
+        faiss.write_index(index, output_index)
+
+    os.makedirs(output_dir, exist_ok=True)
+    report = dedup_report(dedup_stats, len(ids), time.perf_counter() - encode_start, dim)
+    with open(os.path.join(output_dir, DEDUP_REPORT_FILE), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    with open(output_ids, "w", encoding="utf-8") as f:
+        json.dump(ids, f, ensure_ascii=False, indent=2)
 
-    os.makedirs(os.path.dirname(OUTPUT_INDEX), exist_ok=True)
-    faiss.write_index(index, OUTPUT_INDEX)
+    # ===== 预计算融合用的整数表 (chunk→doc、doc→归一化URL分组) =====
+    table = build_doc_table(ids, {d: page["url"] for d, page in docs.items()})
+    save_doc_table(table, output_dir)
 
-    with open(OUTPUT_IDS, "w", encoding="utf-8") as f:
-        json.dump(ids, f, ensure_ascii=False, indent=2)
+    # ===== 导出多 worker 共享 (mmap) 格式 =====
+    export_shared_index(output_dir, ids, table, docs, vectors=embeddings)
 
     print("\n🎉 完成！")
-    print(f"向量索引保存在：{OUTPUT_INDEX}")
-    print(f"chunk-ID 映射保存在：{OUTPUT_IDS}")
+    if n_shards > 0:
+        print(f"分片索引保存在：{os.path.join(output_dir, SHARDS_SUBDIR)}（启动服务时设置 CAMPUS_DENSE_SHARDS=1）")
+    else:
+        print(f"向量索引保存在：{output_index}")
+    print(f"chunk-ID 映射保存在：{output_ids}")
+    print(f"融合整数表保存在：{output_dir}")
+    print(f"去重统计：节省编码 {report['encodes_saved']} 次（约 {report['encode_seconds_saved']}s），"
+          f"索引减少 {report['index_mb_saved']} MB，详见 {DEDUP_REPORT_FILE}")
 
 
 if __name__ == "__main__":
@@ -1,11 +1,11 @@
 import json
-import re
 import time
 import requests
 from bs4 import BeautifulSoup
 import os
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
+from fusion import normalize_url
 
 # ================= 配置区域 =================
 INPUT_FILE = "temp_urls.json"
@@ -16,15 +16,6 @@ USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36
 MAX_WORKERS = 50
 # ===========================================
 
-def normalize_url(url):
-    """URL 归一化"""
-    if not url: return ""
-    u = url.strip()
-    u = u.replace("https://", "").replace("http://", "")
-    u = u.rstrip("/")
-    u = re.sub(r'/index\.(html|htm|php|jsp|asp|aspx)$', '', u, flags=re.IGNORECASE)
-    return u
-
 def fetch_and_process(task):
     """
     单个任务处理
@@ -3,21 +3,40 @@ os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 os.environ["OMP_NUM_THREADS"] = "1"
 
 import json
+import logging
+from functools import lru_cache
+
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
+import fusion
+from encoder import load_encoder
+from fusion import load_doc_table
+from metrics import stage
+from shared_index import mmap_enabled, MmapDocStore, open_dense_index, open_chunk_ids
+from dense_shards import shards_enabled, ShardedDenseIndex, SHARDS_SUBDIR
 
 FAISS_INDEX_PATH = "dense_index/dense.index"
 ID_MAPPING_PATH = "dense_index/docids.json"
 CORPUS_PATH = "corpus_dir/corpus.jsonl"   # ← NEW：读取网页 url/contents
 MODEL_NAME = "BAAI/bge-small-zh-v1.5"
 
+# 自适应扩召回：首轮取 n_docs * OVERFETCH_FACTOR 个 chunk，不够再按比例扩大
+OVERFETCH_FACTOR = 2
+MAX_FETCH = 20000
+
+logger = logging.getLogger(__name__)
+
 
 # ========== 加载 corpus（一次加载） ==========
+@lru_cache(maxsize=1)
 def load_corpus():
+    if mmap_enabled():
+        # 多 worker：文档库 mmap 打开，所有进程共享同一份 page cache
+        return MmapDocStore(fusion.DOC_TABLE_DIR, load_doc_table())
+
     corpus = {}
     if not os.path.exists(CORPUS_PATH):
-        print("❌ 未找到 corpus.jsonl，请确认路径")
+        logger.error("❌ 未找到 corpus.jsonl，请确认路径: %s", CORPUS_PATH)
         return corpus
     
     with open(CORPUS_PATH, "r", encoding="utf-8") as f:
@@ -30,15 +49,28 @@ def load_corpus():
     return corpus
 
 
+@lru_cache(maxsize=1)
 def load_dense_index():
-    index = faiss.read_index(FAISS_INDEX_PATH)
+    if shards_enabled():
+        # 分片模式：每个分片一个本地进程，检索时 scatter-gather
+        index = ShardedDenseIndex(os.path.join(fusion.DOC_TABLE_DIR, SHARDS_SUBDIR))
+    elif mmap_enabled():
+        index = open_dense_index(FAISS_INDEX_PATH, fusion.DOC_TABLE_DIR)
+    else:
+        index = faiss.read_index(FAISS_INDEX_PATH)
+
+    if mmap_enabled():
+        return index, open_chunk_ids(fusion.DOC_TABLE_DIR, load_doc_table())
+
     with open(ID_MAPPING_PATH, "r", encoding="utf-8") as f:
         ids = json.load(f)
     return index, ids
 
 
+@lru_cache(maxsize=1)
 def load_model():
-    return SentenceTransformer(MODEL_NAME)
+    # 后端由 CAMPUS_ENCODER 选择（torch / onnx / onnx-int8），见 encoder.py
+    return load_encoder(MODEL_NAME)
 
 
 def encode(model, text):
@@ -46,6 +78,85 @@ def encode(model, text):
     return emb.astype("float32")
 
 
+@lru_cache(maxsize=1024)
+def encode_query(query):
+    """同一个查询在一次请求里会被检索和答案缓存各用一次，这里只编码一次"""
+    emb = encode(load_model(), query)
+    emb.flags.writeable = False
+    return emb
+
+
+def encode_queries(queries):
+    """批量编码多个查询，一次前向"""
+    return load_model().encode(list(queries), normalize_embeddings=True).astype("float32")
+
+
+def _first_fetch(index, n_docs, max_fetch):
+    return min(max(n_docs * OVERFETCH_FACTOR, 1), index.ntotal, max_fetch)
+
+
+def dense_chunk_search(query, n_docs, max_fetch=MAX_FETCH):
+    """
+    返回按相似度排好的 chunk 行号与分数，保证覆盖至少 n_docs 个不同文档
+    （或索引已经取尽 / 达到 max_fetch）。
+
+    同一篇长文档可能占据大量 chunk 名额，所以不够时会按「已得文档数 / 目标文档数」
+    的比例扩大召回量重新检索。
+    """
+    with stage("dense.encode"):
+        q_emb = encode_query(query)
+    return _cover_docs(q_emb, n_docs, max_fetch)
+
+
+def dense_chunk_search_batch(queries, n_docs, max_fetch=MAX_FETCH):
+    """
+    批量版 dense_chunk_search：一次编码所有查询、一次多查询 FAISS 检索；
+    首轮没能覆盖 n_docs 个文档的查询再单独扩召回。返回每个查询的 (idxs, dists)。
+    """
+    index, _ = load_dense_index()
+    with stage("dense.encode_batch"):
+        q_embs = encode_queries(queries)
+    fetch = _first_fetch(index, n_docs, max_fetch)
+    with stage("dense.faiss_batch"):
+        dists, idxs = index.search(q_embs, fetch)
+    return [
+        _cover_docs(q_embs[i:i + 1], n_docs, max_fetch, first_round=(dists[i], idxs[i]))
+        for i in range(len(queries))
+    ]
+
+
+def _cover_docs(q_emb, n_docs, max_fetch, first_round=None):
+    """自适应扩召回直到覆盖 n_docs 个文档；first_round 为已经检索好的首轮结果 (dists, idxs)"""
+    index, _ = load_dense_index()
+    chunk_doc = load_doc_table().chunk_doc
+
+    fetch = _first_fetch(index, n_docs, max_fetch)
+    while True:
+        fetch = min(fetch, index.ntotal, max_fetch)
+        if first_round is not None:
+            (dists, idxs), first_round = first_round, None
+        else:
+            with stage("dense.faiss"):
+                dists, idxs = index.search(q_emb, fetch)
+            dists, idxs = dists[0], idxs[0]
+        valid = idxs >= 0
+        dists, idxs = dists[valid], idxs[valid]
+
+        docs = chunk_doc[idxs]
+        _, first = np.unique(docs, return_index=True)
+        n_distinct = len(first)
+        if n_distinct >= n_docs or fetch >= index.ntotal or fetch >= max_fetch:
+            break
+        fetch = max(fetch * 2, int(fetch * n_docs / max(n_distinct, 1) * 1.2))
+        logger.debug("Dense 扩召回: 已覆盖 %d/%d 篇文档，chunk 数扩大到 %d", n_distinct, n_docs, fetch)
+
+    # 截断到恰好覆盖 n_docs 个文档的位置，让候选集规模与 BM25 一侧对齐
+    if n_distinct > n_docs:
+        cut = np.sort(first)[n_docs - 1] + 1
+        dists, idxs = dists[:cut], idxs[:cut]
+    return idxs, dists
+
+
 def dense_search(query, top_k=5):
     model = load_model()
     index, ids = load_dense_index()
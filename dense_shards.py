@@ -0,0 +1,354 @@
+# dense_shards.py
+"""
+分片稠密索引 (scatter-gather)。
+
+把 chunk 向量按行号切成 N 个连续区间，每个分片独立构建、由一个本地 worker 进程加载；
+查询时同时下发到所有分片，再按分数合并各分片的 top-k。某个分片缺失、崩溃或超时时
+直接用其余分片的结果（部分结果），不拖住整个请求。
+
+开启：CAMPUS_DENSE_SHARDS=1（读取 dense_index/shards/manifest.json）
+构建：build_dense_index.py 中设置 N_SHARDS > 0（各分片并行编码）
+切分：python dense_shards.py --split 4        （把已有整体索引切成分片，无需重新编码）
+评测：python dense_shards.py --bench --shards 1,2,4
+"""
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+os.environ["OMP_NUM_THREADS"] = "1"
+
+import json
+import time
+import atexit
+import shutil
+import logging
+import argparse
+import itertools
+import tempfile
+import threading
+import multiprocessing as mp
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+
+import faiss
+import numpy as np
+
+from metrics import Counter, annotate
+from shared_index import mmap_enabled
+
+SHARDS_SUBDIR = "shards"
+MANIFEST_FILE = "manifest.json"
+SHARD_TIMEOUT = float(os.getenv("CAMPUS_SHARD_TIMEOUT", "0.5"))   # 单次检索等待分片的秒数
+SHARD_START_TIMEOUT = 120                                          # 分片进程加载索引的最长等待
+
+SHARD_EVENTS = Counter("campus_dense_shard_events_total", "分片检索异常（超时/不可用/出错）", ["shard", "result"])
+
+logger = logging.getLogger(__name__)
+
+
+def shards_enabled() -> bool:
+    return os.getenv("CAMPUS_DENSE_SHARDS", "0") == "1"
+
+
+class ShardUnavailable(RuntimeError):
+    pass
+
+
+# ========== 构建 ==========
+def _write_manifest(out_dir, dim, shards):
+    manifest = {
+        "n_shards": len(shards),
+        "dim": dim,
+        "total": sum(s["hi"] - s["lo"] for s in shards),
+        "shards": shards,
+    }
+    with open(os.path.join(out_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _build_shard(shard_dir, texts, model, keys=None):
+    """在子进程中编码一个分片的 chunk 并写出 FAISS 索引，返回 (dim, 耗时秒)"""
+    from build_dense_index import encode_chunks, load_default_model
+
+    start = time.perf_counter()
+    model = model if model is not None else load_default_model()
+    dim = model.get_sentence_embedding_dimension()
+    index = faiss.IndexFlatIP(dim)
+    if texts:
+        index.add(encode_chunks(model, texts, desc=os.path.basename(shard_dir), keys=keys))
+    os.makedirs(shard_dir, exist_ok=True)
+    faiss.write_index(index, os.path.join(shard_dir, "dense.index"))
+    return dim, time.perf_counter() - start
+
+
+def build_shards(texts, out_dir, n_shards, model=None, workers=None, keys=None):
+    """
+    按行号连续切成 n_shards 份并行构建。
+
+    :param model: 可 pickle 的编码器；为 None 时每个子进程各自加载默认模型
+    :param keys: 与 texts 对应的 chunk 哈希（见 build_dense_index.drop_boilerplate），按同样区间切给各分片
+    """
+    bounds = np.linspace(0, len(texts), n_shards + 1).astype(int)
+    ctx = mp.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers or n_shards, mp_context=ctx) as ex:
+        futures = [
+            ex.submit(_build_shard, os.path.join(out_dir, f"shard{i}"), texts[bounds[i]:bounds[i + 1]], model,
+                      keys[bounds[i]:bounds[i + 1]] if keys is not None else None)
+            for i in range(n_shards)
+        ]
+        results = [f.result() for f in futures]
+
+    for i, (_, seconds) in enumerate(results):
+        print(f"  分片 {i}: {bounds[i + 1] - bounds[i]} 个 chunk，耗时 {seconds:.1f}s")
+    shards = [{"path": f"shard{i}", "lo": int(bounds[i]), "hi": int(bounds[i + 1])} for i in range(n_shards)]
+    return _write_manifest(out_dir, results[0][0], shards)
+
+
+def split_index(index_path, out_dir, n_shards):
+    """把已有的整体 IndexFlatIP 切成 n_shards 个分片（直接复制向量，不重新编码）"""
+    index = faiss.read_index(index_path)
+    bounds = np.linspace(0, index.ntotal, n_shards + 1).astype(int)
+    shards = []
+    for i in range(n_shards):
+        lo, hi = int(bounds[i]), int(bounds[i + 1])
+        shard = faiss.IndexFlatIP(index.d)
+        if hi > lo:
+            shard.add(index.reconstruct_n(lo, hi - lo))
+        shard_dir = os.path.join(out_dir, f"shard{i}")
+        os.makedirs(shard_dir, exist_ok=True)
+        faiss.write_index(shard, os.path.join(shard_dir, "dense.index"))
+        shards.append({"path": f"shard{i}", "lo": lo, "hi": hi})
+    return _write_manifest(out_dir, index.d, shards)
+
+
+# ========== 分片 worker 进程 ==========
+def _serve_shard(shard_dir, lo, conn):
+    """分片进程主循环：收到 (req_id, q, k) 就检索，把本地行号加上 lo 换成全局行号返回"""
+    # CAMPUS_MMAP=1 时 mmap 打开分片索引，多个 worker 各自的分片进程共用同一份 page cache
+    io_flags = faiss.IO_FLAG_MMAP_IFC if mmap_enabled() and hasattr(faiss, "IO_FLAG_MMAP_IFC") else 0
+    try:
+        index = faiss.read_index(os.path.join(shard_dir, "dense.index"), io_flags)
+    except Exception as e:
+        conn.send(("error", str(e)))
+        return
+    conn.send(("ready", index.ntotal))
+
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        if msg is None:
+            break
+        req_id, q, k = msg
+        k = min(k, index.ntotal)
+        if k == 0:
+            conn.send((req_id, np.empty((len(q), 0), np.float32), np.empty((len(q), 0), np.int64)))
+            continue
+        dists, idxs = index.search(q, k)
+        conn.send((req_id, dists, np.where(idxs >= 0, idxs + lo, -1)))
+
+
+class _ShardClient:
+    """
+    主进程一侧的分片句柄：后台线程接收结果，按请求 id 分发给等待中的 Future。
+    构造时只启动进程，须再调用 wait_ready 等待索引加载完成。
+    """
+
+    def __init__(self, shard_id, shard_dir, lo, ctx):
+        self.shard_id = shard_id
+        self.alive = False
+        self._closing = False
+        self.ntotal = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(target=_serve_shard, args=(shard_dir, lo, child), daemon=True)
+        self.proc.start()
+        child.close()
+
+    def wait_ready(self, timeout):
+        """等待分片进程发来就绪消息，成功后启动接收线程"""
+        try:
+            ready = self.conn.poll(max(timeout, 0))
+            status, payload = self.conn.recv() if ready else (None, None)
+        except (EOFError, OSError) as e:
+            ready, status, payload = True, "error", f"进程退出 ({e!r})"
+        if ready:
+            if status == "ready":
+                self.alive, self.ntotal = True, payload
+            else:
+                logger.error("❌ 分片 %d 加载失败: %s", self.shard_id, payload)
+        else:
+            logger.error("❌ 分片 %d 启动超时", self.shard_id)
+
+        if self.alive:
+            threading.Thread(target=self._read_loop, daemon=True).start()
+        return self.alive
+
+    def _mark_dead(self, reason):
+        with self._lock:
+            self.alive = False
+            pending, self._pending = self._pending, {}
+        logger.error("❌ 分片 %d 不可用: %s", self.shard_id, reason)
+        for fut in pending.values():
+            fut.set_exception(ShardUnavailable(reason))
+
+    def _read_loop(self):
+        while True:
+            try:
+                req_id, dists, idxs = self.conn.recv()
+            except (EOFError, OSError) as e:
+                if not self._closing:
+                    self._mark_dead(f"连接断开 ({e!r})")
+                return
+            with self._lock:
+                fut = self._pending.pop(req_id, None)
+            # 已超时放弃的请求，迟到的结果直接丢弃
+            if fut is not None:
+                fut.set_result((dists, idxs))
+
+    def submit(self, req_id, q, k) -> Future:
+        fut = Future()
+        with self._lock:
+            if not self.alive:
+                fut.set_exception(ShardUnavailable("分片未就绪"))
+                return fut
+            self._pending[req_id] = fut
+            try:
+                self.conn.send((req_id, q, k))
+            except (BrokenPipeError, OSError) as e:
+                self._pending.pop(req_id, None)
+                fut.set_exception(ShardUnavailable(repr(e)))
+        return fut
+
+    def abandon(self, req_id):
+        with self._lock:
+            self._pending.pop(req_id, None)
+
+    def close(self):
+        self._closing = True
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.proc.join(timeout=5)
+
+
+class ShardedDenseIndex:
+    """对外提供与 faiss 索引相同的 search(q, k) / ntotal / d，内部 scatter-gather 到各分片进程"""
+
+    def __init__(self, shards_dir, timeout=SHARD_TIMEOUT):
+        with open(os.path.join(shards_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.d = manifest["dim"]
+        self.ntotal = manifest["total"]
+        self.timeout = timeout
+        self._req_ids = itertools.count()
+
+        ctx = mp.get_context("spawn")
+        self.clients = [
+            _ShardClient(i, os.path.join(shards_dir, s["path"]), s["lo"], ctx)
+            for i, s in enumerate(manifest["shards"])
+        ]
+        # 所有分片进程已同时开始加载，这里共用一个截止时间，启动耗时取决于最慢的分片而非各分片之和
+        deadline = time.monotonic() + SHARD_START_TIMEOUT
+        alive = sum(c.wait_ready(deadline - time.monotonic()) for c in self.clients)
+        logger.info("🧩 Dense 分片已就绪 %d/%d", alive, len(self.clients))
+        atexit.register(self.close)
+
+    def search(self, q, k):
+        req_id = next(self._req_ids)
+        futures = {c.submit(req_id, q, k): c for c in self.clients}
+        done, not_done = wait(futures, timeout=self.timeout)
+
+        dists, idxs, missing = [], [], []
+        for fut in done:
+            client = futures[fut]
+            if fut.exception() is not None:
+                SHARD_EVENTS.inc(shard=client.shard_id, result="unavailable")
+                missing.append(client.shard_id)
+            else:
+                d, i = fut.result()
+                dists.append(d)
+                idxs.append(i)
+        for fut in not_done:
+            client = futures[fut]
+            client.abandon(req_id)
+            SHARD_EVENTS.inc(shard=client.shard_id, result="timeout")
+            missing.append(client.shard_id)
+
+        if missing:
+            logger.warning("⚠️ Dense 分片 %s 未返回，使用部分结果", sorted(missing))
+            annotate(dense_partial=True, dense_missing_shards=sorted(missing))
+        if not dists:
+            return np.empty((len(q), 0), np.float32), np.empty((len(q), 0), np.int64)
+
+        # 每个查询（每一行）各自按分数合并
+        all_d = np.concatenate(dists, axis=1)
+        all_i = np.concatenate(idxs, axis=1)
+        order = np.argsort(-all_d, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(all_d, order, axis=1), np.take_along_axis(all_i, order, axis=1)
+
+    def close(self):
+        for c in self.clients:
+            c.close()
+
+
+# ========== 加速比评测 ==========
+def shard_speedup_report(index_path, shard_counts, n_queries=200, k=100):
+    """把整体索引切成不同分片数，比较单查询延迟；基准为不分片、同进程的 faiss 检索"""
+    base = faiss.read_index(index_path)
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((n_queries, base.d)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    def measure(index):
+        index.search(queries[:1], k)   # 预热
+        lat = []
+        for q in queries:
+            start = time.perf_counter()
+            index.search(q[None, :], k)
+            lat.append((time.perf_counter() - start) * 1000)
+        return np.asarray(lat)
+
+    base_lat = measure(base)
+    rows = [{"shards": 0, "mode": "in-process", "mean_ms": round(float(base_lat.mean()), 3),
+             "p99_ms": round(float(np.percentile(base_lat, 99)), 3), "speedup": 1.0}]
+    print(json.dumps(rows[0], ensure_ascii=False))
+
+    for n in shard_counts:
+        tmp = tempfile.mkdtemp(prefix=f"campus_shards{n}_")
+        try:
+            split_index(index_path, tmp, n)
+            sharded = ShardedDenseIndex(tmp, timeout=60)
+            lat = measure(sharded)
+            sharded.close()
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        row = {"shards": n, "mode": "scatter-gather", "mean_ms": round(float(lat.mean()), 3),
+               "p99_ms": round(float(np.percentile(lat, 99)), 3),
+               "speedup": round(float(base_lat.mean() / lat.mean()), 2)}
+        rows.append(row)
+        print(json.dumps(row, ensure_ascii=False))
+    return rows
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    parser = argparse.ArgumentParser(description="分片稠密索引：切分与加速比评测")
+    parser.add_argument("--index", default="dense_index/dense.index", help="整体 FAISS 索引路径")
+    parser.add_argument("--split", type=int, help="把整体索引切成 N 个分片，写入 dense_index/shards")
+    parser.add_argument("--bench", action="store_true", help="评测不同分片数下的检索延迟与加速比")
+    parser.add_argument("--shards", default="1,2,4", help="评测用的分片数列表")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.split:
+        out = os.path.join(os.path.dirname(args.index), SHARDS_SUBDIR)
+        manifest = split_index(args.index, out, args.split)
+        print(f"✅ 已切成 {manifest['n_shards']} 个分片（共 {manifest['total']} 个 chunk）：{out}")
+    if args.bench:
+        shard_speedup_report(args.index, [int(n) for n in args.shards.split(",")], args.queries, args.k)
+    if not (args.split or args.bench):
+        parser.print_help()
@@ -0,0 +1,255 @@
+# encoder.py
+"""
+查询 / chunk 编码器后端。
+
+- torch     ：原来的 SentenceTransformer (PyTorch)
+- onnx      ：导出的 ONNX 模型，用 ONNX Runtime 在 CPU 上推理
+- onnx-int8 ：在 onnx 基础上做动态 int8 量化
+
+通过环境变量 CAMPUS_ENCODER 选择，dense_search 与 build_dense_index 都走这里加载。
+ONNX 后端不需要 import torch，冷启动更快；导出时会和 PyTorch 模型逐条比对余弦相似度，
+未通过校验的模型不会被加载（退回 torch 并报错）。
+
+导出：python encoder.py --export
+对比：python encoder.py --compare        （延迟 / 与 torch 的余弦相似度 / 检索结果重合率）
+"""
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+os.environ["OMP_NUM_THREADS"] = "1"
+
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+
+ONNX_DIR = "onnx_encoder"
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_INT8_FILE = "model.int8.onnx"
+ENCODER_CONFIG_FILE = "encoder_config.json"
+ONNX_THREADS = int(os.getenv("CAMPUS_ONNX_THREADS", "1"))
+
+# 与 PyTorch 输出的最小余弦相似度要求
+FP32_TOLERANCE = 0.999
+INT8_TOLERANCE = 0.98
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+VERIFY_TEXTS = [
+    "中国人民大学 高瓴人工智能学院",
+    "人工智能专业的培养方案是什么？",
+    "图书馆开放时间",
+    "本科招生简章与录取分数线",
+    "国家奖学金评选办法及申请材料",
+    "研究生院关于学位论文答辩的通知",
+    "Computer Science and Artificial Intelligence",
+    "校园卡丢失后如何补办",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def encoder_backend() -> str:
+    return os.getenv("CAMPUS_ENCODER", "torch")
+
+
+class OnnxEncoder:
+    """接口与 SentenceTransformer 的 encode / get_sentence_embedding_dimension 一致"""
+
+    def __init__(self, model_dir=ONNX_DIR, quantized=False):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, ENCODER_CONFIG_FILE), "r", encoding="utf-8") as f:
+            self.config = json.load(f)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = ONNX_THREADS
+        opts.inter_op_num_threads = 1
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        path = os.path.join(model_dir, ONNX_INT8_FILE if quantized else ONNX_MODEL_FILE)
+        self.session = ort.InferenceSession(path, opts, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def get_sentence_embedding_dimension(self):
+        return self.config["dim"]
+
+    def _encode_batch(self, texts):
+        tokens = self.tokenizer(texts, padding=True, truncation=True,
+                                max_length=self.config["max_length"], return_tensors="np")
+        feed = {n: tokens[n].astype(np.int64) for n in self.input_names}
+        hidden = self.session.run(["last_hidden_state"], feed)[0]
+        if self.config["pooling"] == "cls":
+            return hidden[:, 0]
+        mask = tokens["attention_mask"][..., None].astype(hidden.dtype)
+        return (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+    def encode(self, texts, normalize_embeddings=True, batch_size=32, **kwargs):
+        if isinstance(texts, str):
+            texts = [texts]
+        embs = np.vstack([self._encode_batch(texts[i:i + batch_size])
+                          for i in range(0, len(texts), batch_size)]).astype(np.float32)
+        if normalize_embeddings:
+            embs /= np.maximum(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12)
+        return embs
+
+
+def load_encoder(model_name, backend=None, model_dir=ONNX_DIR):
+    """按后端加载编码器；ONNX 模型不存在或未通过校验时退回 torch"""
+    backend = backend or encoder_backend()
+    if backend not in BACKENDS:
+        raise ValueError(f"未知编码器后端: {backend}，可选: {BACKENDS}")
+
+    if backend != "torch":
+        config_path = os.path.join(model_dir, ENCODER_CONFIG_FILE)
+        verified = {}
+        if os.path.exists(config_path):
+            with open(config_path, "r", encoding="utf-8") as f:
+                verified = json.load(f).get("verified", {})
+        if verified.get(backend, {}).get("passed"):
+            logger.info("加载 %s 编码器: %s", backend, model_dir)
+            return OnnxEncoder(model_dir, quantized=(backend == "onnx-int8"))
+        logger.error("❌ %s 编码器未导出或未通过校验，请先运行 python encoder.py --export；暂时使用 torch", backend)
+
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+
+# ========== 导出与校验 ==========
+def verify_encoder(reference, candidate, texts=VERIFY_TEXTS, tolerance=FP32_TOLERANCE):
+    """逐条比较两个编码器输出的余弦相似度（都已归一化，直接点积）"""
+    ref = reference.encode(texts, normalize_embeddings=True)
+    cand = candidate.encode(texts, normalize_embeddings=True)
+    cos = (ref * cand).sum(axis=1)
+    return {
+        "min_cosine": round(float(cos.min()), 6),
+        "mean_cosine": round(float(cos.mean()), 6),
+        "tolerance": tolerance,
+        "passed": bool(cos.min() >= tolerance),
+    }
+
+
+def export_onnx(model_name, out_dir=ONNX_DIR, quantize=True, opset=14,
+                fp32_tolerance=FP32_TOLERANCE, int8_tolerance=INT8_TOLERANCE):
+    """导出 ONNX（可选 int8 量化），并与 PyTorch 模型比对后写入校验结果"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    st = SentenceTransformer(model_name, device="cpu")
+    transformer = st[0].auto_model.eval()
+    tokenizer = st.tokenizer
+    pooling = "cls" if getattr(st[1], "pooling_mode_cls_token", False) else "mean"
+
+    os.makedirs(out_dir, exist_ok=True)
+    dummy = tokenizer(["示例文本"], return_tensors="pt", padding=True)
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in dummy]
+    dynamic_axes = {n: {0: "batch", 1: "seq"} for n in input_names + ["last_hidden_state"]}
+    fp32_path = os.path.join(out_dir, ONNX_MODEL_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer, tuple(dummy[n] for n in input_names), fp32_path,
+            input_names=input_names, output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes, opset_version=opset,
+        )
+    print(f"✅ 已导出 ONNX: {fp32_path}")
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(fp32_path, os.path.join(out_dir, ONNX_INT8_FILE), weight_type=QuantType.QInt8)
+        print(f"✅ 已量化 int8: {os.path.join(out_dir, ONNX_INT8_FILE)}")
+
+    tokenizer.save_pretrained(out_dir)
+    config = {
+        "model_name": model_name,
+        "pooling": pooling,
+        "max_length": st.max_seq_length,
+        "dim": st.get_sentence_embedding_dimension(),
+        "verified": {},
+    }
+    config_path = os.path.join(out_dir, ENCODER_CONFIG_FILE)
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+    checks = [("onnx", False, fp32_tolerance)] + ([("onnx-int8", True, int8_tolerance)] if quantize else [])
+    for backend, quantized, tol in checks:
+        result = verify_encoder(st, OnnxEncoder(out_dir, quantized=quantized), tolerance=tol)
+        config["verified"][backend] = result
+        flag = "✅" if result["passed"] else "❌"
+        print(f"{flag} {backend} 校验: 最小余弦 {result['min_cosine']}（要求 ≥ {tol}）")
+
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    return config
+
+
+# ========== 对比报告 ==========
+def compare_backends(model_name, queries, k=10, backends=BACKENDS):
+    """
+    对比各后端：冷启动加载时间、单条查询编码延迟、与 torch 的余弦相似度，
+    以及在现有稠密索引上 top-k 结果与 torch 的重合率 (recall@k vs torch)。
+    """
+    from dense_search import load_dense_index
+
+    index, _ = load_dense_index()
+    rows, ref_embs, ref_topk = [], None, None
+    for backend in backends:
+        start = time.perf_counter()
+        enc = load_encoder(model_name, backend=backend)
+        load_s = time.perf_counter() - start
+
+        enc.encode(queries[:1], normalize_embeddings=True)   # 预热
+        lat = []
+        embs = []
+        for q in queries:
+            t = time.perf_counter()
+            embs.append(enc.encode([q], normalize_embeddings=True))
+            lat.append((time.perf_counter() - t) * 1000)
+        embs = np.vstack(embs).astype(np.float32)
+        _, topk = index.search(embs, k)
+
+        if ref_embs is None:
+            ref_embs, ref_topk = embs, topk
+        cos = (embs * ref_embs).sum(axis=1)
+        overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(topk, ref_topk)])
+        lat = np.asarray(lat)
+        row = {
+            "backend": backend,
+            "load_s": round(load_s, 2),
+            "p50_ms": round(float(np.percentile(lat, 50)), 2),
+            "p99_ms": round(float(np.percentile(lat, 99)), 2),
+            "min_cosine_vs_torch": round(float(cos.min()), 5),
+            f"recall@{k}_vs_torch": round(float(overlap), 4),
+        }
+        rows.append(row)
+        print(json.dumps(row, ensure_ascii=False))
+    return rows
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    from dense_search import MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="编码器后端：ONNX 导出 / 校验 / 对比")
+    parser.add_argument("--export", action="store_true", help="导出 ONNX 模型并与 PyTorch 比对")
+    parser.add_argument("--no-quantize", action="store_true", help="只导出 fp32，不做 int8 量化")
+    parser.add_argument("--fp32-tolerance", type=float, default=FP32_TOLERANCE)
+    parser.add_argument("--int8-tolerance", type=float, default=INT8_TOLERANCE)
+    parser.add_argument("--compare", action="store_true", help="对比各后端的延迟与检索结果")
+    parser.add_argument("--queries", help="对比用的查询文件（格式同 benchmark.py），默认使用内置样例")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.export:
+        export_onnx(MODEL_NAME, quantize=not args.no_quantize,
+                    fp32_tolerance=args.fp32_tolerance, int8_tolerance=args.int8_tolerance)
+    if args.compare:
+        if args.queries:
+            from benchmark import load_queries
+            queries = [q["query"] for q in load_queries(args.queries)]
+        else:
+            queries = VERIFY_TEXTS
+        compare_backends(MODEL_NAME, queries, k=args.k)
+    if not (args.export or args.compare):
+        parser.print_help()
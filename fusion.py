@@ -0,0 +1,234 @@
+# fusion.py
+"""
+向量化的多路召回融合 (RRF)。
+
+所有计算都在整数 doc id 上用 NumPy 完成：
+- 每一路召回可以配置权重，RRF 常数 k 可调；
+- 同一文档的多个 chunk 命中按 max / sum 聚合；
+- URL 归一化在建索引时就算好，查询时只做整数比较去重。
+"""
+import os
+import re
+import json
+import logging
+from functools import lru_cache
+
+import numpy as np
+
+DOC_TABLE_DIR = "dense_index"
+DOC_IDS_FILE = "doc_ids.json"         # 整数 id -> 原始 docid (如 doc123)
+CHUNK_DOC_FILE = "chunk_doc.npy"      # chunk 行号 -> 整数 doc id
+DOC_URL_IDS_FILE = "doc_url_ids.npy"  # 整数 doc id -> 归一化 URL 分组 id
+
+SOURCE_NAMES = ["bm25", "dense"]
+
+logger = logging.getLogger(__name__)
+
+
+class DocTable:
+    """docid 与整数 id 的映射，以及 chunk→doc、doc→URL 分组 两张整数表"""
+
+    def __init__(self, doc_ids, chunk_doc, url_ids):
+        self.doc_ids = doc_ids
+        self.id_of = {d: i for i, d in enumerate(doc_ids)}
+        self.chunk_doc = chunk_doc
+        self.url_ids = url_ids
+
+    def to_int(self, docids):
+        """字符串 docid 列表 -> 整数 id 数组，未知 docid 记为 -1"""
+        return np.fromiter(
+            (self.id_of.get(d, -1) for d in docids), dtype=np.int64, count=len(docids)
+        )
+
+
+def chunk_docid(chunk_id: str) -> str:
+    """doc123_chunk4 -> doc123"""
+    return chunk_id.split("_chunk")[0]
+
+
+def chunk_no(chunk_id: str) -> int:
+    """doc123_chunk4 -> 4"""
+    return int(chunk_id.rsplit("_chunk", 1)[1])
+
+
+def normalize_url(url):
+    """URL 归一化（去协议、末尾斜杠与 index.* 首页），爬虫去重与建索引共用"""
+    if not url: return ""
+    u = url.strip()
+    u = u.replace("https://", "").replace("http://", "")
+    u = u.rstrip("/")
+    u = re.sub(r'/index\.(html|htm|php|jsp|asp|aspx)$', '', u, flags=re.IGNORECASE)
+    return u
+
+
+def build_doc_table(chunk_ids, doc_urls):
+    """
+    建索引时调用，预先算好整数表。
+
+    :param chunk_ids: 与 FAISS 行号一一对应的 chunk id 列表
+    :param doc_urls: {docid: url}，覆盖整个语料（BM25 能搜到的文档都要在里面）
+    """
+    doc_ids = list(doc_urls.keys())
+    id_of = {d: i for i, d in enumerate(doc_ids)}
+    for cid in chunk_ids:
+        d = chunk_docid(cid)
+        if d not in id_of:
+            id_of[d] = len(doc_ids)
+            doc_ids.append(d)
+
+    chunk_doc = np.fromiter(
+        (id_of[chunk_docid(cid)] for cid in chunk_ids), dtype=np.int32, count=len(chunk_ids)
+    )
+
+    # 归一化后相同的 URL 分到同一组；没有 URL 的文档各自独占一组，避免被误判为重复
+    group_of = {}
+    url_ids = np.empty(len(doc_ids), dtype=np.int32)
+    for i, d in enumerate(doc_ids):
+        norm = normalize_url(doc_urls.get(d, ""))
+        key = norm if norm else ("", i)
+        url_ids[i] = group_of.setdefault(key, len(group_of))
+
+    return DocTable(doc_ids, chunk_doc, url_ids)
+
+
+def save_doc_table(table: DocTable, out_dir: str = DOC_TABLE_DIR):
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, DOC_IDS_FILE), "w", encoding="utf-8") as f:
+        json.dump(table.doc_ids, f, ensure_ascii=False)
+    np.save(os.path.join(out_dir, CHUNK_DOC_FILE), table.chunk_doc)
+    np.save(os.path.join(out_dir, DOC_URL_IDS_FILE), table.url_ids)
+
+
+@lru_cache(maxsize=1)
+def load_doc_table(table_dir: str = None) -> DocTable:
+    """
+    加载整数表（CAMPUS_MMAP=1 时以 mmap 方式打开共享格式）；
+    旧索引没有这些文件时，根据 docids.json + corpus 现场生成一次并落盘
+    """
+    table_dir = table_dir or DOC_TABLE_DIR
+
+    from shared_index import mmap_enabled, MmapDocTable
+    if mmap_enabled():
+        return MmapDocTable(table_dir)
+
+    ids_path = os.path.join(table_dir, DOC_IDS_FILE)
+    if os.path.exists(ids_path):
+        with open(ids_path, "r", encoding="utf-8") as f:
+            doc_ids = json.load(f)
+        chunk_doc = np.load(os.path.join(table_dir, CHUNK_DOC_FILE))
+        url_ids = np.load(os.path.join(table_dir, DOC_URL_IDS_FILE))
+        return DocTable(doc_ids, chunk_doc, url_ids)
+
+    from dense_search import load_dense_index, load_corpus
+
+    logger.warning("⚠️ 未找到 doc 整数表，正在根据现有索引生成（仅首次）...")
+    _, chunk_ids = load_dense_index()
+    corpus = load_corpus()
+    table = build_doc_table(chunk_ids, {d: page["url"] for d, page in corpus.items()})
+    save_doc_table(table, table_dir)
+    return table
+
+
+def rrf_fuse(sources, weights=None, k: int = 60, agg: str = "max"):
+    """
+    加权 RRF 融合。
+
+    :param sources: 每一路召回的整数 doc id 数组，按排名从高到低；同一文档可重复出现（多个 chunk 命中）
+    :param weights: 每一路的权重，默认全为 1
+    :param k: RRF 常数
+    :param agg: 同一路内同一文档多次命中的聚合方式，"max" 只取最高排名，"sum" 累加
+    :return: (doc_ids, scores, source_mask)，按融合分数降序；source_mask 第 j 位表示第 j 路命中
+    """
+    if agg not in ("max", "sum"):
+        raise ValueError(f"agg 只能是 'max' 或 'sum'，收到: {agg}")
+    sources = [np.asarray(s, dtype=np.int64) for s in sources]
+    if weights is None:
+        weights = [1.0] * len(sources)
+
+    all_ids = np.concatenate(sources) if sources else np.empty(0, dtype=np.int64)
+    uniq, inv = np.unique(all_ids, return_inverse=True)
+    scores = np.zeros(len(uniq), dtype=np.float64)
+    mask = np.zeros(len(uniq), dtype=np.int64)
+
+    offset = 0
+    for j, (src, w) in enumerate(zip(sources, weights)):
+        n = len(src)
+        pos = inv[offset:offset + n]
+        offset += n
+        if n == 0:
+            continue
+        contrib = w / (k + np.arange(1, n + 1, dtype=np.float64))
+        if agg == "sum":
+            scores += np.bincount(pos, weights=contrib, minlength=len(uniq))
+        else:
+            # 排名越靠前贡献越大，所以首次出现即为最大贡献
+            _, first = np.unique(pos, return_index=True)
+            scores[pos[first]] += contrib[first]
+        mask[pos] |= 1 << j
+
+    order = np.argsort(-scores, kind="stable")
+    return uniq[order], scores[order], mask[order]
+
+
+def rrf_fuse_batch(sources, weights=None, k: int = 60, agg: str = "max"):
+    """
+    多个查询一起做加权 RRF，结果与逐条调用 rrf_fuse 完全一致。
+
+    :param sources: sources[j][q] 为第 j 路召回对第 q 个查询的整数 doc id 数组
+    :return: 每个查询一个 (doc_ids, scores, source_mask)
+    """
+    if agg not in ("max", "sum"):
+        raise ValueError(f"agg 只能是 'max' 或 'sum'，收到: {agg}")
+    n_queries = len(sources[0]) if sources else 0
+    if weights is None:
+        weights = [1.0] * len(sources)
+
+    # (查询序号, doc id) 编码成一个整数 key，所有查询、所有路一次 unique
+    lists = [[np.asarray(ids, dtype=np.int64) for ids in src] for src in sources]
+    n_ids = 1 + max((int(ids.max()) for src in lists for ids in src if len(ids)), default=0)
+    keys, ranks = [], []
+    for src in lists:
+        lengths = np.fromiter((len(ids) for ids in src), dtype=np.int64, count=n_queries)
+        starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        qidx = np.repeat(np.arange(n_queries, dtype=np.int64), lengths)
+        flat = np.concatenate(src) if n_queries else np.empty(0, dtype=np.int64)
+        keys.append(qidx * n_ids + flat)
+        ranks.append(np.arange(len(flat), dtype=np.int64) - starts + 1)
+
+    uniq, inv = np.unique(np.concatenate(keys), return_inverse=True)
+    scores = np.zeros(len(uniq), dtype=np.float64)
+    mask = np.zeros(len(uniq), dtype=np.int64)
+    offset = 0
+    for j, (key, rank, w) in enumerate(zip(keys, ranks, weights)):
+        pos = inv[offset:offset + len(key)]
+        offset += len(key)
+        if len(key) == 0:
+            continue
+        contrib = w / (k + rank.astype(np.float64))
+        if agg == "sum":
+            scores += np.bincount(pos, weights=contrib, minlength=len(uniq))
+        else:
+            # 每个查询内排名递增，同一 key 首次出现即为最高排名
+            _, first = np.unique(pos, return_index=True)
+            scores[pos[first]] += contrib[first]
+        mask[pos] |= 1 << j
+
+    # 按 (查询, 分数降序, doc id) 排序后切回每个查询
+    qidx, doc_ids = uniq // n_ids, uniq % n_ids
+    order = np.lexsort((doc_ids, -scores, qidx))
+    bounds = np.searchsorted(qidx[order], np.arange(n_queries + 1))
+    return [
+        (doc_ids[order[lo:hi]], scores[order[lo:hi]], mask[order[lo:hi]])
+        for lo, hi in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def dedupe_by_url(doc_ids, url_ids, top_k: int):
+    """按预先算好的 URL 分组去重，保留每组中排名最高的文档，返回保留位置的下标"""
+    groups = url_ids[doc_ids]
+    _, first = np.unique(groups, return_index=True)
+    return np.sort(first)[:top_k]
+
+
+def source_names(mask: int, names=SOURCE_NAMES):
+    return [name for j, name in enumerate(names) if mask & (1 << j)]
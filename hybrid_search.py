@@ -3,133 +3,118 @@ import os
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 os.environ["OMP_NUM_THREADS"] = "1"
 
-import json
-import re
-from bm_search import bm25_search
-from dense_search import dense_search
-
-def hybrid_search(query: str, top_k: int = 10, k: int = 60):
+import numpy as np
+from bm_search import bm25_docids, bm25_docids_batch
+from dense_search import dense_chunk_search, dense_chunk_search_batch, load_corpus, load_dense_index
+from fusion import load_doc_table, rrf_fuse, rrf_fuse_batch, dedupe_by_url, source_names, chunk_no
+from passages import select_passages
+from metrics import stage
+
+# 各路召回的默认权重，可在调用时按需覆盖
+DEFAULT_WEIGHTS = {"bm25": 1.0, "dense": 1.0}
+# 批量检索时每批的查询数；每批各阶段一起执行，完成后逐条产出结果
+BATCH_SIZE = 32
+
+def hybrid_search(query: str, top_k: int = 10, k: int = 60, weights: dict = None,
+                  agg: str = "max", candidate_k: int = None, with_passages: bool = False):
     """
-    使用 RRF (倒雷融合) 进行混合检索。
-    公式: Score = 1 / (k + rank)
+    使用加权 RRF (倒数排名融合) 进行混合检索。
+    公式: Score = Σ w_source / (k + rank)
     
     :param k: RRF 常数，通常设为 60。
+    :param weights: 各路权重，如 {"bm25": 1.0, "dense": 0.8}，缺省项取 DEFAULT_WEIGHTS
+    :param agg: 同一文档多个 chunk 命中时的聚合方式，"max"（只算最高排名）或 "sum"
+    :param candidate_k: 每一路召回的文档数，默认 top_k * 5
+    :param with_passages: 是否为每条结果挑选命中片段 ("passages")，只有拼提示词的 RAG / 重排需要
     """
-    
-    # 1. 并行获取结果 (通常取比最终 top_k 更多的候选集，比如 50)
-    candidate_k = top_k * 5 
-    bm25_hits = bm25_search(query, k=candidate_k)
-    dense_hits = dense_search(query, top_k=candidate_k)
-
-    # 用于存储融合分数
-    # 格式: {docid: {"score": 0.0, "content": "...", "url": "...", "from": set()}}
-    fusion_dict = {}
-
-    # ===========================
-    # 2. 处理 BM25 结果 (基于排名)
-    # ===========================
-    for rank, hit in enumerate(bm25_hits):
-        docid = hit["docid"]
-        
-        # 初始化
-        if docid not in fusion_dict:
-            fusion_dict[docid] = {
-                "score": 0.0, 
-                "content": hit.get("contents", ""), 
-                "url": hit.get("url", ""), 
-                "from": set()
-            }
-        
-        # RRF 累加
-        fusion_dict[docid]["score"] += 1.0 / (k + rank + 1)
-        fusion_dict[docid]["from"].add("bm25")
-
-    # ===========================
-    # 3. 处理 Dense 结果 (关键：解决 Chunk ID 问题)
-    # ===========================
-    # 记录 Dense 这一侧已经处理过的 docid，防止同一文档的多个 chunk 重复加分
-    # 策略：如果一篇文档多个 chunk 命中，我们只取排名最高的那一次（或者你也可以累加，但通常取最高即可）
-    seen_dense_docs = set()
-
-    for rank, hit in enumerate(dense_hits):
-        raw_id = hit["docid"]
-        # 🔥 关键修复：从 "doc123_chunk4" 还原为 "doc123"
-        real_docid = raw_id.split("_chunk")[0] 
-
-        if real_docid in seen_dense_docs:
-            continue # 同一文档的后续 chunk 不再参与排名计算（避免长文档霸榜）
-            
-        seen_dense_docs.add(real_docid)
-
-        # 初始化 (如果 BM25 没搜到这个)
-        if real_docid not in fusion_dict:
-            # 注意：这里需要你 dense_search 返回 content/url
-            # 如果 dense_search 没返回，可能需要单独查，或者只用 BM25 的元数据
-            fusion_dict[real_docid] = {
-                "score": 0.0, 
-                "content": hit.get("contents", "Dense结果暂无预览"), 
-                "url": hit.get("url", ""), 
-                "from": set()
-            }
-
-        # RRF 累加
-        fusion_dict[real_docid]["score"] += 1.0 / (k + rank + 1)
-        fusion_dict[real_docid]["from"].add("dense")
-
-    # ===========================
-    # 4. 排序与格式化
-    # ===========================
-    # 按 RRF 分数倒序
-    sorted_docs = sorted(fusion_dict.items(), key=lambda x: x[1]["score"], reverse=True)
-    
-    # ===========================
-    # 🔥 新增：结果去重逻辑 (De-duplication)
-    # ===========================
+    # 1. 召回：两路都取 candidate_k 个不同文档
+    candidate_k = candidate_k or top_k * 5
+    table = load_doc_table()
+
+    with stage("hybrid.bm25"):
+        bm25_ids = table.to_int(bm25_docids(query, k=candidate_k))
+        bm25_ids = bm25_ids[bm25_ids >= 0]
+
+    # Dense 是 chunk 级别的，会自适应扩召回直到覆盖 candidate_k 个文档
+    with stage("hybrid.dense"):
+        chunk_idxs, _ = dense_chunk_search(query, n_docs=candidate_k)
+        dense_ids = table.chunk_doc[chunk_idxs]
+
+    # 2. 融合 (整数 id 上的向量化 RRF)
+    # 3. 按预先算好的归一化 URL 分组去重 (解决 index.htm / http(s) / 末尾斜杠问题)
+    with stage("hybrid.fusion"):
+        w = {**DEFAULT_WEIGHTS, **(weights or {})}
+        doc_ids, scores, masks = rrf_fuse(
+            [bm25_ids, dense_ids], [w["bm25"], w["dense"]], k=k, agg=agg
+        )
+        keep = dedupe_by_url(doc_ids, table.url_ids, top_k)
+
+    with stage("hybrid.hydrate"):
+        return _hydrate(query, table, doc_ids, scores, masks, keep, chunk_idxs, dense_ids, with_passages)
+
+def _hydrate(query, table, doc_ids, scores, masks, keep, chunk_idxs, dense_ids, with_passages=False):
+    """把融合、去重后的整数结果还原成带原文的结果列表，with_passages 时附带命中片段"""
+    # 4. 记录最终文档在 Dense 侧命中的 chunk（按相似度排序），供段落级上下文使用
+    doc_chunks = {}
+    if with_passages:
+        _, chunk_ids = load_dense_index()
+        in_final = np.isin(dense_ids, doc_ids[keep])
+        for row, d in zip(chunk_idxs[in_final], dense_ids[in_final]):
+            doc_chunks.setdefault(int(d), []).append(chunk_no(chunk_ids[row]))
+
+    # 5. 只为最终结果取回原文
+    corpus = load_corpus()
     final_results = []
-    seen_identifiers = set()
-
-    for docid, data in sorted_docs:
-        url = data["url"]
-        content = data["content"]
-        
-        # --- 策略 A: URL 归一化 (解决 index.htm 问题) ---
-        # 1. 去除 http/https 前缀差异
-        norm_url = url.replace("https://", "").replace("http://", "")
-        # 2. 去除末尾的斜杠
-        norm_url = norm_url.rstrip("/")
-        # 3. 去除默认首页文件名 (index.html, index.htm, default.aspx 等)
-        norm_url = re.sub(r'/index\.(html|htm|php|jsp)$', '', norm_url, flags=re.IGNORECASE)
-        
-        # --- 策略 B: 内容指纹 (解决 URL 不同但内容完全一样的问题) ---
-        # 取前 50 个字符作为指纹（一般首页的前 50 字都是一样的标题）
-        # 如果你想更严格，可以用 hashlib.md5(content.encode()).hexdigest()
-        content_fingerprint = content[:50].strip()
-
-        # 检查是否重复
-        # 如果 URL 归一化后相同，或者内容指纹完全相同，就视为重复
-        if norm_url in seen_identifiers:
-            continue
-        # if content_fingerprint in seen_identifiers: # 可选：如果 URL 不同但内容一样也想去重，开启这行
-        #     continue
-
-        # 记录已出现的特征
-        seen_identifiers.add(norm_url)
-        # seen_identifiers.add(content_fingerprint) 
-
-        # 加入最终结果
-        final_results.append({
+    for i in keep:
+        docid = table.doc_ids[doc_ids[i]]
+        page = corpus.get(docid, {})
+        content = page.get("contents", "")
+        sources = source_names(int(masks[i]))
+        hit = {
             "docid": docid,
-            "score": data["score"],
-            "url": url,       # 还是返回原始 URL 给用户
+            "score": float(scores[i]),
+            "url": page.get("url", ""),     # 还是返回原始 URL 给用户
             "contents": content,
-            "from": list(data["from"])
-        })
-
-        if len(final_results) >= top_k:
-            break
+            "from": sources,
+        }
+        if with_passages:
+            hit["passages"] = select_passages(query, content, doc_chunks.get(int(doc_ids[i]), []),
+                                              use_highlight="bm25" in sources)
+        final_results.append(hit)
 
     return final_results
 
+def hybrid_search_batch(queries, top_k: int = 10, k: int = 60, weights: dict = None,
+                        agg: str = "max", candidate_k: int = None, batch_size: int = BATCH_SIZE,
+                        with_passages: bool = False):
+    """
+    批量混合检索（生成器）。每批内 BM25 走 batch_search、Dense 一次编码 + 一次多查询检索、
+    RRF 一次向量化融合；每批完成后逐条 yield (查询序号, 结果列表)，结果与 hybrid_search 一致。
+    """
+    candidate_k = candidate_k or top_k * 5
+    table = load_doc_table()
+    w = {**DEFAULT_WEIGHTS, **(weights or {})}
+
+    for start in range(0, len(queries), batch_size):
+        batch = list(queries[start:start + batch_size])
+        with stage("hybrid.bm25_batch"):
+            bm25_ids = [ids[ids >= 0] for ids in map(table.to_int, bm25_docids_batch(batch, k=candidate_k))]
+
+        with stage("hybrid.dense_batch"):
+            dense_hits = dense_chunk_search_batch(batch, n_docs=candidate_k)
+            dense_ids = [table.chunk_doc[idxs] for idxs, _ in dense_hits]
+
+        with stage("hybrid.fusion_batch"):
+            fused = rrf_fuse_batch([bm25_ids, dense_ids], [w["bm25"], w["dense"]], k=k, agg=agg)
+
+        for j, query in enumerate(batch):
+            doc_ids, scores, masks = fused[j]
+            keep = dedupe_by_url(doc_ids, table.url_ids, top_k)
+            with stage("hybrid.hydrate"):
+                results = _hydrate(query, table, doc_ids, scores, masks, keep, dense_hits[j][0], dense_ids[j],
+                                   with_passages)
+            yield start + j, results
+
 if __name__ == "__main__":
     q = "中国人民大学 高瓴人工智能学院 人工智能 专业介绍"
     
@@ -6,36 +6,56 @@
 
 import os
 import json
+import logging
 from typing import List, Dict
-from openai import OpenAI
+from functools import lru_cache
 
 # 导入模块
 from hybrid_search import hybrid_search
-from bm_search import get_searcher
+from passages import pack_passages
+from metrics import stage, annotate
+
+# 候选文档片段部分的 token 预算
+PROMPT_TOKEN_BUDGET = 2000
+
+logger = logging.getLogger(__name__)
 
 # 配置 DeepSeek
-client = OpenAI(
-    api_key=os.getenv("DEEPSEEK_API_KEY"),
-    base_url="https://api.deepseek.com/v1"
-)
+@lru_cache(maxsize=1)
+def get_client():
+    # 首次使用（或启动预热）时才创建，避免 import 阶段的开销
+    from openai import OpenAI
+    return OpenAI(
+        api_key=os.getenv("DEEPSEEK_API_KEY"),
+        base_url="https://api.deepseek.com/v1"
+    )
 
-def _build_rerank_prompt(query: str, docs: List[Dict]) -> str:
-    """构造给 LLM 的打分提示词"""
+def _build_rerank_prompt(query: str, docs: List[Dict], token_budget: int = PROMPT_TOKEN_BUDGET):
+    """
+    构造给 LLM 的打分提示词（每篇文档只携带命中片段，受 token 预算约束）
+    :return: (prompt, 实际装入提示词的文档列表)
+    """
     lines = []
     lines.append("你是一个搜索引擎的相关性评估助手。")
     lines.append("请为以下文档打分（0-5分），0=无关，5=高度相关。")
     lines.append(f"用户查询：{query}\n")
     lines.append("候选文档列表：")
 
-    for i, d in enumerate(docs, 1):
-        # 截取前 300 字
-        snippet = d["contents"].replace("\n", " ")[:300]
+    packed, used = pack_passages(docs, token_budget)
+    logger.info("📏 [Rerank] 候选 %d/%d 篇，约 %d tokens（预算 %d）", len(packed), len(docs), used, token_budget)
+    if len(packed) < len(docs):
+        logger.warning("⚠️ [Rerank] 预算不足，%d 篇候选未进入提示词，按混合检索顺序排在重排结果之后",
+                       len(docs) - len(packed))
+    annotate(rerank_prompt_tokens_est=used, rerank_dropped=len(docs) - len(packed))
+
+    for i, (d, texts) in enumerate(packed, 1):
+        snippet = " … ".join(texts)
         lines.append(f"[DOC_{i}] docid={d['docid']}")
         lines.append(f"内容: {snippet}\n")
 
     lines.append("请只输出 JSON 数组，格式：")
     lines.append('[{"docid": "...", "score": 0-5}, ...]')
-    return "\n".join(lines)
+    return "\n".join(lines), [d for d, _ in packed]
 
 def _parse_llm_json(text: str) -> List[Dict]:
     """解析 LLM 返回的 JSON"""
@@ -53,70 +73,58 @@ def _parse_llm_json(text: str) -> List[Dict]:
     except:
         return []
 
-def llm_rerank(query: str, top_k_candidate: int = 50, top_k_final: int = 10, alpha: float = 0.7) -> List[Dict]:
+def llm_rerank(query: str, top_k_candidate: int = 50, top_k_final: int = 10, alpha: float = 0.7,
+               token_budget: int = PROMPT_TOKEN_BUDGET) -> List[Dict]:
     """
     Hybrid Search -> LLM Rerank
     """
-    # 1. 初筛 (Hybrid)
-    hybrid_hits = hybrid_search(query, top_k=top_k_candidate, k=60)
+    # 1. 初筛 (Hybrid)，结果已带原文与命中片段
+    hybrid_hits = hybrid_search(query, top_k=top_k_candidate, k=60, with_passages=True)
 
-    # 2. 🔥【核心修复】创建一次 Searcher，而不是在循环里创建
-    searcher = get_searcher()
-    
-    docs = []
-    for h in hybrid_hits:
-        try:
-            # 3. 查原文
-            doc = searcher.doc(h["docid"])
-            if doc:
-                raw = json.loads(doc.raw())
-                docs.append({
-                    "docid": h["docid"],
-                    "url": raw.get("url", ""),
-                    "contents": raw.get("contents", ""),
-                    "hybrid_score": h["score"]
-                })
-        except Exception as e:
-            print(f"⚠️ 文档读取失败: {h['docid']} - {e}")
-            continue
+    docs = [
+        {**h, "hybrid_score": h["score"]}
+        for h in hybrid_hits if h["contents"]
+    ]
 
     if not docs:
         return []
 
-    # 4. 调用 LLM 进行重排
-    prompt = _build_rerank_prompt(query, docs)
+    # 2. 调用 LLM 进行重排
+    prompt, judged = _build_rerank_prompt(query, docs, token_budget)
     
     try:
-        resp = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": "你是一个严谨的搜索相关性打分器，只输出JSON。"},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0,
-        )
+        with stage("llm.rerank"):
+            resp = get_client().chat.completions.create(
+                model="deepseek-chat",
+                messages=[
+                    {"role": "system", "content": "你是一个严谨的搜索相关性打分器，只输出JSON。"},
+                    {"role": "user", "content": prompt},
+                ],
+                temperature=0,
+            )
+        if resp.usage:
+            logger.info("📏 [Rerank] DeepSeek 计费 prompt_tokens=%d", resp.usage.prompt_tokens)
+            annotate(rerank_prompt_tokens=resp.usage.prompt_tokens)
         scored_list = _parse_llm_json(resp.choices[0].message.content)
     except Exception as e:
-        print(f"❌ LLM Rerank 失败: {e}")
+        logger.error("❌ LLM Rerank 失败: %s", e)
         scored_list = []
 
-    # 5. 分数融合 (LLM Score + Hybrid Score)
+    # 3. 分数融合 (LLM Score + Hybrid Score)
     score_map = {item["docid"]: float(item["score"]) for item in scored_list if "docid" in item and "score" in item}
 
-    reranked = []
-    for d in docs:
-        docid = d["docid"]
-        llm_score = score_map.get(docid, 0.0)
+    def to_result(d, llm_score):
         # 综合分：主要看 LLM，Hybrid 微调
-        final_score = llm_score + 0.1 * d["hybrid_score"]
-        
-        reranked.append({
-            "docid": docid,
+        return {
+            "docid": d["docid"],
             "url": d["url"],
             "contents": d["contents"],
-            "final_score": final_score
-        })
+            "final_score": llm_score + 0.1 * d["hybrid_score"]
+        }
 
-    # 6. 排序并返回 Top K
+    # 4. 只对真正进入提示词的候选按综合分排序；未装入的候选没有被 LLM 看过，按混合检索顺序接在后面
+    reranked = [to_result(d, score_map.get(d["docid"], 0.0)) for d in judged]
     reranked.sort(key=lambda x: x["final_score"], reverse=True)
+    judged_ids = {d["docid"] for d in judged}
+    reranked += [to_result(d, 0.0) for d in docs if d["docid"] not in judged_ids]
     return reranked[:top_k_final]
\ No newline at end of file
@@ -0,0 +1,98 @@
+# loadtest.py
+"""
+压测正在运行的服务，观察过载时的降级与拒绝行为（见 admission.py）。
+
+按若干并发档位依次发压，每档统计：
+- 延迟分位数 (p50 / p95 / p99) 与吞吐
+- 状态码分布（503 即被拒绝）
+- 各降级模式的响应数（no_rerank / degraded_cached / retrieval_only）
+
+用法：
+    python main.py &
+    python loadtest.py --endpoint search --use-llm --concurrency 1,8,32,64
+    python loadtest.py --endpoint ask --queries queries.jsonl --requests 300
+"""
+import json
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from benchmark import load_queries
+
+DEFAULT_QUERIES = [
+    "人工智能 培养方案",
+    "图书馆开放时间",
+    "本科招生简章",
+    "国家奖学金评选办法",
+    "研究生学位论文答辩",
+    "校园卡补办",
+    "高瓴人工智能学院",
+    "选课 退课 时间",
+]
+
+
+def send(url, endpoint, query, use_llm, timeout):
+    body = {"query": query} if endpoint == "ask" else {"query": query, "top_k": 10, "use_llm": use_llm}
+    start = time.perf_counter()
+    try:
+        resp = requests.post(f"{url}/{endpoint}", json=body, timeout=timeout)
+        data = resp.json() if resp.status_code == 200 else {}
+        # 接口出错时 HTTP 仍为 200，错误码在响应体的 code 字段里
+        status = data.get("code", resp.status_code)
+        degraded = data.get("degraded")
+    except requests.RequestException:
+        status, degraded = "timeout", None
+    return time.perf_counter() - start, status, degraded
+
+
+def run_level(url, endpoint, queries, concurrency, n_requests, use_llm, timeout):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        results = list(ex.map(
+            lambda i: send(url, endpoint, queries[i % len(queries)], use_llm, timeout),
+            range(n_requests),
+        ))
+    wall = time.perf_counter() - start
+
+    lat = np.asarray([r[0] for r in results]) * 1000
+    ok_lat = np.asarray([r[0] for r in results if r[1] == 200]) * 1000
+    pct = lambda a, p: round(float(np.percentile(a, p)), 1) if len(a) else None
+    return {
+        "concurrency": concurrency,
+        "requests": n_requests,
+        "qps": round(n_requests / wall, 2),
+        "p50_ms": pct(lat, 50),
+        "p95_ms": pct(lat, 95),
+        "p99_ms": pct(lat, 99),
+        "ok_p99_ms": pct(ok_lat, 99),       # 只统计成功响应
+        "status": dict(Counter(str(r[1]) for r in results)),
+        "degraded": dict(Counter(r[2] for r in results if r[2])),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="服务压测：观察过载时的降级与 p99")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--endpoint", choices=["search", "ask"], default="search")
+    parser.add_argument("--use-llm", action="store_true", help="/search 请求带 use_llm=True")
+    parser.add_argument("--queries", help="查询文件（格式同 benchmark.py），默认使用内置样例")
+    parser.add_argument("--concurrency", default="1,8,32,64", help="逗号分隔的并发档位")
+    parser.add_argument("--requests", type=int, default=200, help="每个并发档位发送的请求数")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", default="loadtest_report.json")
+    args = parser.parse_args()
+
+    queries = [q["query"] for q in load_queries(args.queries)] if args.queries else DEFAULT_QUERIES
+    report = []
+    for c in [int(x) for x in args.concurrency.split(",")]:
+        row = run_level(args.url, args.endpoint, queries, c, args.requests, args.use_llm, args.timeout)
+        report.append(row)
+        print(json.dumps(row, ensure_ascii=False))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"endpoint": args.endpoint, "use_llm": args.use_llm, "levels": report}, f, ensure_ascii=False, indent=2)
+    print(f"✅ 报告已写入 {args.output}")
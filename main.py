@@ -4,17 +4,28 @@ os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 os.environ["OMP_NUM_THREADS"] = "1"
 
 import json
+import logging
+import threading
+import contextvars
+from typing import List
 import uvicorn
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 
-# 导入功能模块
-from llm_rerank import llm_rerank
-from rag_qa import rag_answer
-from hybrid_search import hybrid_search
-from bm_search import get_searcher
+# 只导入轻量模块；检索 / 模型 / LLM 相关模块由 warmup 在后台加载，端口可以立即绑定
+from metrics import request_trace, stage, annotate, render_metrics
+from warmup import READINESS
+from admission import (ADMISSION, Overloaded, DEGRADED_RESPONSES, RETRY_AFTER, STAGE_WAIT,
+                       LEVEL_NO_RERANK, LEVEL_NO_GENERATION)
+
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger("main")
 
 app = FastAPI(title="智能校园搜索")
 
@@ -26,6 +37,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def start_warmup():
+    READINESS.start()
+
+def require_ready():
+    """组件仍在预热时短暂等待，超时返回 503，由客户端 / 负载均衡稍后重试"""
+    if not READINESS.wait():
+        raise HTTPException(status_code=503, detail="服务预热中，请稍后重试", headers={"Retry-After": "5"})
+
 class SearchRequest(BaseModel):
     query: str
     top_k: int = 10
@@ -34,6 +54,13 @@ class SearchRequest(BaseModel):
 class QARequest(BaseModel):
     query: str
 
+# 单次批量请求允许的最大查询数
+MAX_BATCH_QUERIES = 1000
+
+class BatchSearchRequest(BaseModel):
+    queries: List[str]
+    top_k: int = 10
+
 @app.get("/")
 def read_root():
     if os.path.exists("index.html"):
@@ -47,67 +74,211 @@ def extract_title(content: str) -> str:
     if len(title) > 40: title = title[:40] + "..."
     return title
 
+def format_hit(h: dict) -> dict:
+    # hybrid_search 已经取回了原文，无需再查 Lucene
+    content = h.get("contents", "")
+    return {
+        "docid": h["docid"],
+        "url": h.get("url", ""),
+        "score": h.get("score"),
+        "title": extract_title(content),
+        "preview": content[:150].replace("\n", " ") + "..."
+    }
+
+def shed():
+    """检索槽位已满：503 + Retry-After，提示客户端稍后重试"""
+    raise HTTPException(status_code=503, detail="服务繁忙，请稍后重试", headers={"Retry-After": str(RETRY_AFTER)})
+
+def mark_degraded(mode: str):
+    DEGRADED_RESPONSES.inc(mode=mode)
+    annotate(degraded=mode)
+    logger.warning("⚠️ 负载过高，降级为 %s", mode)
+
 # --- 搜索接口 ---
 @app.post("/search")
 def search_api(req: SearchRequest):
     if not req.query.strip():
         raise HTTPException(status_code=400, detail="Query cannot be empty")
+    require_ready()
     
+    with request_trace("/search", query=req.query, use_llm=req.use_llm):
+        try:
+            with ADMISSION.admit() as level:
+                return run_search(req, level)
+        except Overloaded:
+            shed()
+
+def run_search(req: SearchRequest, level: int):
+    from llm_rerank import llm_rerank
+    from hybrid_search import hybrid_search
+
     response_data = []
     try:
-        if req.use_llm:
-            print(f"🔍 [Search] DeepSeek Rerank | Query: {req.query}")
-            results = llm_rerank(req.query, top_k_candidate=20, top_k_final=req.top_k, alpha=0.7)
-            for r in results:
-                content = r.get("contents", "")
-                response_data.append({
-                    "docid": r.get("docid"),
-                    "url": r.get("url"),
-                    "score": r.get("final_score"),
-                    "title": extract_title(content),
-                    "preview": content[:150].replace("\n", " ") + "..." 
-                })
-        else:
-            print(f"🔍 [Search] Hybrid Only | Query: {req.query}")
-            hybrid_results = hybrid_search(req.query, top_k=req.top_k, alpha=0.7)
-            searcher = get_searcher()
-            for h in hybrid_results:
-                content = ""
-                url = ""
-                try:
-                    lucene_doc = searcher.doc(h["docid"])
-                    if lucene_doc:
-                        raw = json.loads(lucene_doc.raw())
-                        content = raw.get("contents", "")
-                        url = raw.get("url", "")
-                except: pass
-                
-                response_data.append({
-                    "docid": h["docid"],
-                    "url": url,
-                    "score": h.get("score"),
-                    "title": extract_title(content),
-                    "preview": content[:150].replace("\n", " ") + "..."
-                })
-
-        return {"code": 200, "data": response_data}
+        # 负载升高或重排槽位已满时跳过 LLM 重排，只返回混合检索结果
+        with ADMISSION.slot("rerank", wait=STAGE_WAIT, enabled=req.use_llm and level < LEVEL_NO_RERANK) as use_rerank:
+            degraded = "no_rerank" if req.use_llm and not use_rerank else None
+            if degraded:
+                mark_degraded(degraded)
+            if use_rerank:
+                logger.info("🔍 [Search] DeepSeek Rerank | Query: %s", req.query)
+                with stage("rerank"):
+                    results = llm_rerank(req.query, top_k_candidate=20, top_k_final=req.top_k, alpha=0.7)
+                for r in results:
+                    content = r.get("contents", "")
+                    response_data.append({
+                        "docid": r.get("docid"),
+                        "url": r.get("url"),
+                        "score": r.get("final_score"),
+                        "title": extract_title(content),
+                        "preview": content[:150].replace("\n", " ") + "..." 
+                    })
+            else:
+                logger.info("🔍 [Search] Hybrid Only | Query: %s", req.query)
+                with stage("hybrid"):
+                    hybrid_results = hybrid_search(req.query, top_k=req.top_k)
+                response_data = [format_hit(h) for h in hybrid_results]
+
+        return {"code": 200, "data": response_data, "degraded": degraded}
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ /search 处理失败")
         return {"code": 500, "error": str(e)}
 
+# --- 批量搜索接口：NDJSON 流式返回，每完成一条输出一行 ---
+@app.post("/search/batch")
+def search_batch_api(req: BatchSearchRequest):
+    if not req.queries or any(not q.strip() for q in req.queries):
+        raise HTTPException(status_code=400, detail="Queries cannot be empty")
+    if len(req.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_QUERIES} queries per batch")
+    require_ready()
+    if not ADMISSION.acquire_batch():
+        DEGRADED_RESPONSES.inc(mode="shed")
+        shed()
+    from hybrid_search import hybrid_search_batch
+
+    def results():
+        try:
+            for i, hits in hybrid_search_batch(req.queries, top_k=req.top_k):
+                line = {"index": i, "query": req.queries[i], "data": [format_hit(h) for h in hits]}
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+        except Exception as e:
+            logger.exception("❌ /search/batch 处理失败")
+            yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+
+    try:
+        body = BatchStream(results(), "/search/batch", ADMISSION.release_batch, queries=len(req.queries))
+    except BaseException:
+        ADMISSION.release_batch()
+        raise
+    return StreamingResponse(body, media_type="application/x-ndjson", background=BackgroundTask(body.close))
+
+class BatchStream:
+    """
+    /search/batch 的响应体。StreamingResponse 每取一条都在线程池里另起上下文执行，
+    所以在自己的 Context 中进入 request_trace 并逐条产出，各批次的阶段耗时记入同一条 trace。
+
+    close() 结束 trace 并释放准入槽位，只执行一次：响应发送完由 BackgroundTask 调用；
+    流没开始就失败或客户端中途断开时，由对象回收时兜底调用。
+    """
+
+    def __init__(self, gen, endpoint, on_close, **attrs):
+        self._gen = gen
+        self._on_close = on_close
+        self._lock = threading.Lock()
+        self._closed = True         # 进入 trace 之前构造失败的话，由调用方释放槽位
+        self._ctx = contextvars.copy_context()
+        self._trace = request_trace(endpoint, **attrs)
+        self._ctx.run(self._trace.__enter__)
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._ctx.run(next, self._gen)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        try:
+            self._ctx.run(self._gen.close)
+            self._ctx.run(self._trace.__exit__, None, None, None)
+        except (RuntimeError, ValueError):
+            # 生成器仍在别的线程里执行（客户端断开），trace 不再输出，但槽位必须释放
+            logger.warning("⚠️ [Batch] 流未正常结束，跳过 trace")
+        finally:
+            self._on_close()
+
+    def __del__(self):
+        self.close()
+
 # --- 🔥 问答接口 (RAG) ---
 @app.post("/ask")
 def ask_api(req: QARequest):
-    print(f"🤖 [QA] Generating Answer | Query: {req.query}")
+    require_ready()
+    with request_trace("/ask", query=req.query):
+        logger.info("🤖 [QA] Generating Answer | Query: %s", req.query)
+        try:
+            with ADMISSION.admit() as level:
+                return run_ask(req, level)
+        except Overloaded:
+            shed()
+
+def run_ask(req: QARequest, level: int):
+    from rag_qa import answer_with_mode
     try:
-        # 调用 rag_qa.py 里的逻辑
-        answer = rag_answer(query=req.query, top_k=5)
-        return {"code": 200, "answer": answer}
+        # 调用 rag_qa.py 里的逻辑；过载或生成槽位已满时只用缓存答案或检索摘录，不再调用 DeepSeek
+        with ADMISSION.slot("generation", wait=STAGE_WAIT, enabled=level < LEVEL_NO_GENERATION) as allow_generate:
+            result = answer_with_mode(query=req.query, top_k=5, allow_generate=allow_generate)
+        degraded = result["mode"] if result["mode"] in ("degraded_cached", "retrieval_only") else None
+        if degraded:
+            mark_degraded(degraded)
+        return {"code": 200, "answer": result["answer"], "mode": result["mode"], "degraded": degraded}
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ /ask 处理失败")
         return {"code": 500, "error": str(e)}
 
+# --- 答案缓存统计 ---
+@app.get("/cache/stats")
+def cache_stats_api():
+    require_ready()
+    from answer_cache import get_answer_cache
+    return {"code": 200, "data": get_answer_cache().stats()}
+
+# --- 准入控制状态：当前降级档位与各阶段在途数 ---
+@app.get("/admission/stats")
+def admission_stats_api():
+    return {"code": 200, "data": ADMISSION.stats()}
+
+# --- Prometheus 指标 ---
+@app.get("/metrics")
+def metrics_api():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# --- 存活探针：进程能响应即可 ---
+@app.get("/healthz")
+def healthz_api():
+    return {"code": 200, "status": "ok"}
+
+# --- 就绪探针：必需组件全部预热完成才返回 200，附带各组件状态与加载耗时 ---
+@app.get("/ready")
+def ready_api():
+    snapshot = READINESS.snapshot()
+    return JSONResponse(snapshot, status_code=200 if snapshot["ready"] else 503)
+
+# --- 当前 worker 的内存占用 (多 worker 部署时用于确认索引共享生效) ---
+@app.get("/worker/memory")
+def worker_memory_api():
+    from shared_index import process_memory, mmap_enabled
+    return {"code": 200, "data": {"pid": os.getpid(), "mmap": mmap_enabled(), **process_memory()}}
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="localhost", port=8000)
\ No newline at end of file
+    workers = int(os.getenv("WORKERS", "1"))
+    if workers > 1:
+        # 多进程部署：索引、映射表与文档库改为 mmap 打开，所有 worker 共享同一份 page cache
+        os.environ["CAMPUS_MMAP"] = "1"
+        uvicorn.run("main:app", host="localhost", port=8000, workers=workers)
+    else:
+        uvicorn.run(app, host="localhost", port=8000)
\ No newline at end of file
@@ -0,0 +1,174 @@
+# metrics.py
+"""
+轻量级可观测性：分阶段耗时追踪 + Prometheus 文本格式指标（/metrics）。
+
+不额外依赖 prometheus_client，只实现本项目用到的 Counter / Gauge / Histogram。
+用法：
+    with request_trace("/search", query=q):      # 每个请求一条结构化 trace 日志
+        with stage("hybrid.bm25"):                # 每个阶段记录耗时直方图 + 在途数
+            ...
+"""
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(n, "") for n in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self):
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total, n) in self._values.items():
+            cumulative = 0
+            for b, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, [('le', b)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, [('le', '+Inf')])} {n}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {n}")
+        return lines
+
+
+# ========== 本项目的指标 ==========
+REQUEST_LATENCY = Histogram("campus_request_latency_seconds", "HTTP 接口端到端耗时", ["endpoint"])
+STAGE_LATENCY = Histogram("campus_stage_latency_seconds", "各检索/生成阶段耗时", ["stage"])
+INFLIGHT_REQUESTS = Gauge("campus_inflight_requests", "正在处理的请求数", ["endpoint"])
+INFLIGHT_STAGES = Gauge("campus_inflight_stages", "正在执行的阶段数", ["stage"])
+STAGE_ERRORS = Counter("campus_stage_errors_total", "各阶段出错次数", ["stage"])
+CACHE_EVENTS = Counter("campus_cache_events_total", "缓存命中/未命中次数", ["cache", "result"])
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ========== 请求级 trace ==========
+_current_trace = ContextVar("campus_trace", default=None)
+
+
+@contextmanager
+def request_trace(endpoint: str, **attrs):
+    """包住一次请求：统计端到端耗时与在途数，结束时输出一条 JSON trace 日志"""
+    trace = {"trace_id": uuid.uuid4().hex[:16], "endpoint": endpoint, **attrs, "stages": []}
+    token = _current_trace.set(trace)
+    INFLIGHT_REQUESTS.inc(endpoint=endpoint)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        elapsed = time.perf_counter() - start
+        INFLIGHT_REQUESTS.dec(endpoint=endpoint)
+        REQUEST_LATENCY.observe(elapsed, endpoint=endpoint)
+        trace["total_ms"] = round(elapsed * 1000, 2)
+        _current_trace.reset(token)
+        logger.info("trace %s", json.dumps(trace, ensure_ascii=False))
+
+
+@contextmanager
+def stage(name: str):
+    """记录一个阶段的耗时；在 request_trace 内部时同时写入当前请求的 trace"""
+    INFLIGHT_STAGES.inc(stage=name)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        INFLIGHT_STAGES.dec(stage=name)
+        STAGE_LATENCY.observe(elapsed, stage=name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace["stages"].append({"stage": name, "ms": round(elapsed * 1000, 2)})
+
+
+def annotate(**attrs):
+    """给当前请求的 trace 追加字段（如 cache="hit"），不在请求内时忽略"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.update(attrs)
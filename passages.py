@@ -0,0 +1,144 @@
+# passages.py
+"""
+段落级上下文：为每篇候选文档挑出真正命中的片段（Dense 命中的 chunk + BM25 关键词窗口），
+再在给定的 token 预算内把片段打包进 LLM 提示词，替代「截取整篇文档前 N 字」。
+"""
+import re
+
+# 切片参数：建索引 (build_dense_index) 与查询时还原 chunk 原文都以这里为准
+CHUNK_SIZE = 300
+CHUNK_OVERLAP = 50
+
+MAX_CHUNKS_PER_DOC = 2     # 每篇文档最多携带几个 Dense 命中的 chunk
+HIGHLIGHT_SIZE = 200       # BM25 关键词窗口长度（字符）
+FALLBACK_SIZE = 300        # 两路都没有片段时，退回取文档开头
+MAX_TERM_HITS = 500        # 关键词命中位置上限，防止超长文档拖慢窗口计算
+DOC_HEADER_TOKENS = 12     # 每篇文档的 [DOC_i] 标记等固定开销
+
+_CJK = re.compile(r"[\u4e00-\u9fff]")
+
+
+def chunk_text(text, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """把文本切片成 chunk"""
+    text = text.strip()
+    chunks = []
+    start = 0
+
+    while start < len(text):
+        end = min(start + size, len(text))
+        chunks.append(text[start:end])
+        start += size - overlap
+
+    return chunks
+
+
+def chunk_span(text, chunk_no, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """按 chunk_text 的切法还原第 chunk_no 个 chunk 在 strip 后文本中的 (start, end)"""
+    start = chunk_no * (size - overlap)
+    return start, min(start + size, len(text.strip()))
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中文约 0.6 token/字，其它字符约 0.3 token/字"""
+    cjk = len(_CJK.findall(text))
+    return int(cjk * 0.6 + (len(text) - cjk) * 0.3) + 1
+
+
+def query_terms(query: str):
+    """查询切词：英文/数字按空格切，较长的中文串拆成二元组，方便在原文里定位"""
+    terms = set()
+    for tok in query.lower().split():
+        if _CJK.search(tok) and len(tok) > 2:
+            terms.update(tok[i:i + 2] for i in range(len(tok) - 1))
+        else:
+            terms.add(tok)
+    return terms
+
+
+def highlight_window(text: str, terms, size: int = HIGHLIGHT_SIZE):
+    """找出覆盖查询词种类最多（其次命中次数最多）的长度为 size 的窗口，返回 (start, end)"""
+    lower = text.lower()
+    hits = []
+    for t in terms:
+        pos = lower.find(t)
+        while pos != -1 and len(hits) < MAX_TERM_HITS:
+            hits.append((pos, t))
+            pos = lower.find(t, pos + 1)
+    if not hits:
+        return None
+    hits.sort()
+
+    # 双指针：窗口左端对齐某个命中位置
+    best_key, best_pos = (0, 0), hits[0][0]
+    counts = {}
+    j = 0
+    for i, (p, _) in enumerate(hits):
+        while j < len(hits) and hits[j][0] < p + size:
+            counts[hits[j][1]] = counts.get(hits[j][1], 0) + 1
+            j += 1
+        key = (len(counts), j - i)
+        if key > best_key:
+            best_key, best_pos = key, p
+        t = hits[i][1]
+        counts[t] -= 1
+        if counts[t] == 0:
+            del counts[t]
+
+    # 窗口稍微往前留一点上下文
+    start = max(0, best_pos - size // 4)
+    return start, min(start + size, len(text))
+
+
+def select_passages(query: str, contents: str, chunk_nos=(), use_highlight: bool = True):
+    """
+    为一篇文档挑选片段。
+
+    :param chunk_nos: Dense 命中的 chunk 序号，按相似度从高到低
+    :param use_highlight: 是否补充 BM25 关键词窗口（一般在 BM25 命中该文档时开启）
+    :return: [{"text", "source", "start", "end"}]，按重要程度排序
+    """
+    text = contents.strip()
+    passages = []
+    for n in list(chunk_nos)[:MAX_CHUNKS_PER_DOC]:
+        start, end = chunk_span(text, n)
+        if start < end:
+            passages.append({"text": text[start:end], "source": "dense", "start": start, "end": end})
+
+    if use_highlight:
+        span = highlight_window(text, query_terms(query))
+        # 关键词窗口已经落在某个 Dense chunk 里就不重复携带
+        if span and not any(p["start"] <= span[0] and span[1] <= p["end"] for p in passages):
+            passages.append({"text": text[span[0]:span[1]], "source": "bm25",
+                             "start": span[0], "end": span[1]})
+
+    if not passages and text:
+        passages.append({"text": text[:FALLBACK_SIZE], "source": "head",
+                         "start": 0, "end": min(FALLBACK_SIZE, len(text))})
+    return passages
+
+
+def pack_passages(docs, token_budget: int):
+    """
+    在 token 预算内打包片段：先保证每篇文档的最佳片段，再按轮次补充次优片段。
+    放不下的片段跳过，继续尝试后面更短的。
+
+    :param docs: 带 "passages" 字段的文档列表，按相关性排序
+    :return: (packed, used_tokens)，packed 为 [(doc, [片段文本, ...])]，保持原有文档顺序
+    """
+    selected = [[] for _ in docs]
+    used = 0
+    depth = max((len(d.get("passages", [])) for d in docs), default=0)
+    for level in range(depth):
+        for i, d in enumerate(docs):
+            ps = d.get("passages", [])
+            if level >= len(ps):
+                continue
+            text = ps[level]["text"].replace("\n", " ")
+            cost = estimate_tokens(text) + (DOC_HEADER_TOKENS if not selected[i] else 0)
+            if used + cost > token_budget:
+                continue
+            selected[i].append(text)
+            used += cost
+
+    packed = [(d, texts) for d, texts in zip(docs, selected) if texts]
+    return packed, used
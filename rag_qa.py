@@ -1,23 +1,38 @@
 # rag_qa.py
 import os
-import json
-from openai import OpenAI
+import time
+import logging
+from functools import lru_cache
 from hybrid_search import hybrid_search 
-from bm_search import get_searcher # 必须复用这个正确的 searcher
+from passages import pack_passages
+from dense_search import encode_query
+from answer_cache import get_answer_cache, DEGRADED_SIM_THRESHOLD, DEGRADED_DOC_OVERLAP
+from metrics import stage, annotate
+
+# 参考资料部分的 token 预算（片段按相关性依次装入，超出即停止）
+PROMPT_TOKEN_BUDGET = 1500
+
+logger = logging.getLogger(__name__)
 
 # 配置 DeepSeek 客户端
-client = OpenAI(
-    api_key=os.getenv("DEEPSEEK_API_KEY"),
-    base_url="https://api.deepseek.com/v1"
-)
+@lru_cache(maxsize=1)
+def get_client():
+    # 首次使用（或启动预热）时才创建，避免 import 阶段的开销
+    from openai import OpenAI
+    return OpenAI(
+        api_key=os.getenv("DEEPSEEK_API_KEY"),
+        base_url="https://api.deepseek.com/v1"
+    )
+
+def build_prompt(query: str, context_docs: list, token_budget: int = PROMPT_TOKEN_BUDGET) -> str:
+    """构建给大模型的提示词 - 段落级上下文，按 token 预算打包命中片段"""
+    packed, used = pack_passages(context_docs, token_budget)
+    logger.info("📏 [RAG] 参考资料 %d/%d 篇，约 %d tokens（预算 %d）", len(packed), len(context_docs), used, token_budget)
+    annotate(prompt_tokens_est=used)
 
-def build_prompt(query: str, context_docs: list) -> str:
-    """构建给大模型的提示词 - 优化版"""
     context_str = ""
-    for i, doc in enumerate(context_docs, 1):
-        # 稍微增加一点长度，350字
-        content = doc.get("contents", "")[:350].replace("\n", " ")
-        context_str += f"[参考文档{i}]: {content}\n\n"
+    for i, (doc, texts) in enumerate(packed, 1):
+        context_str += f"[参考文档{i}]: {' … '.join(texts)}\n\n"
 
     # 🔥 修改核心：让 AI 既能回答问题，也能总结关键词
     prompt = f"""
@@ -35,58 +50,87 @@ def build_prompt(query: str, context_docs: list) -> str:
     """
     return prompt
 
-def rag_answer(query: str, top_k: int = 5) -> str:
+def retrieval_only_answer(context_docs: list, token_budget: int = PROMPT_TOKEN_BUDGET) -> str:
+    """过载降级：不调用大模型，直接返回最相关的资料摘录"""
+    packed, _ = pack_passages(context_docs, token_budget)
+    lines = ["当前访问人数较多，AI 回答暂不可用。以下是与您的问题最相关的校园资料摘录："]
+    for i, (doc, texts) in enumerate(packed, 1):
+        lines.append(f"\n{i}. {doc.get('url', '')}\n{' … '.join(texts)}")
+    return "\n".join(lines)
+
+def answer_with_mode(query: str, top_k: int = 5, token_budget: int = PROMPT_TOKEN_BUDGET,
+                     use_cache: bool = True, allow_generate: bool = True) -> dict:
     """
-    RAG 流程
+    RAG 流程，返回 {"answer", "mode"}。
+    mode: generated / cached / no_context / error，以及过载降级时的 degraded_cached / retrieval_only
+    :param allow_generate: False 表示不调用 DeepSeek（过载降级，由调用方根据准入结果决定）
     """
-    print(f"🤖 [RAG] 正在思考: {query}")
-    
-    # 1. 检索 (复用 hybrid_search)
-    hits = hybrid_search(query, top_k=top_k)
-    searcher = get_searcher()
+    logger.info("🤖 [RAG] 正在思考: %s", query)
     
-    context_docs = []
-    for h in hits:
-        try:
-            # ✅ 必须使用正确的 .doc().raw() 写法
-            doc = searcher.doc(h["docid"])
-            if doc:
-                raw = json.loads(doc.raw())
-                context_docs.append({
-                    "contents": raw.get("contents", ""),
-                    "url": raw.get("url", "")
-                })
-        except Exception as e:
-            print(f"⚠️ 文档解析跳过: {e}")
-            continue
+    # 1. 检索 (复用 hybrid_search，结果已带原文与命中片段)
+    context_docs = [h for h in hybrid_search(query, top_k=top_k, with_passages=True) if h["contents"]]
 
     if not context_docs:
-        return "抱歉，没有找到相关的校园资料，无法回答您的问题。"
+        return {"answer": "抱歉，没有找到相关的校园资料，无法回答您的问题。", "mode": "no_context"}
 
-    # 2. 构建 Prompt
-    prompt = build_prompt(query, context_docs)
+    # 2. 语义缓存：相似问题 + 相同支撑文档 -> 直接复用答案（过载时放宽匹配条件）
+    doc_ids = [d["docid"] for d in context_docs]
+    if use_cache:
+        cache = get_answer_cache()
+        q_emb = encode_query(query)
+        with stage("answer_cache.lookup"):
+            if allow_generate:
+                cached = cache.lookup(q_emb, doc_ids)
+            else:
+                cached = cache.lookup(q_emb, doc_ids, DEGRADED_SIM_THRESHOLD, DEGRADED_DOC_OVERLAP)
+        annotate(cache="hit" if cached else "miss")
+        if cached:
+            logger.info("⚡ [RAG] 命中答案缓存 (相似度 %.3f，原问题: %s)，节省约 %.2fs",
+                        cached["similarity"], cached["query"], cached["latency"])
+            return {"answer": cached["answer"], "mode": "cached" if allow_generate else "degraded_cached"}
+
+    # 3. 系统过载（或调用方未拿到生成槽位）-> 纯检索摘录
+    if not allow_generate:
+        logger.warning("⚠️ [RAG] 负载过高，跳过生成，返回检索摘录")
+        return {"answer": retrieval_only_answer(context_docs, token_budget), "mode": "retrieval_only"}
+
+    # 4. 构建 Prompt
+    prompt = build_prompt(query, context_docs, token_budget)
     
-    # 🔥 调试打印：让你在后台看到到底发给了 AI 什么
-    print("---------------- PROMPT ----------------")
-    print(prompt[:500] + "...\n(提示词过长已截断)")
-    print("----------------------------------------")
+    # 🔥 调试日志：让你在后台看到到底发给了 AI 什么（DEBUG 级别）
+    logger.debug("PROMPT (前500字):\n%.500s", prompt)
 
-    # 3. 调用 DeepSeek
+    # 5. 调用 DeepSeek
     try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": "你是一个乐于助人的校园问答助手。回答要简洁，语气亲切。"},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0.3, 
-            stream=False # 暂时不用流式，简单点
-        )
+        start = time.perf_counter()
+        with stage("llm.generate"):
+            response = get_client().chat.completions.create(
+                model="deepseek-chat",
+                messages=[
+                    {"role": "system", "content": "你是一个乐于助人的校园问答助手。回答要简洁，语气亲切。"},
+                    {"role": "user", "content": prompt},
+                ],
+                temperature=0.3, 
+                stream=False # 暂时不用流式，简单点
+            )
+        if response.usage:
+            logger.info("📏 [RAG] DeepSeek 计费 prompt_tokens=%d, completion_tokens=%d",
+                        response.usage.prompt_tokens, response.usage.completion_tokens)
+            annotate(prompt_tokens=response.usage.prompt_tokens)
         answer = response.choices[0].message.content
-        return answer
+        if use_cache and answer:
+            cache.put(query, q_emb, doc_ids, answer, time.perf_counter() - start)
+        return {"answer": answer, "mode": "generated"}
     except Exception as e:
-        print(f"❌ LLM 调用出错: {e}")
-        return "抱歉，AI 大脑暂时短路了，请检查 API Key 或网络。"
+        logger.error("❌ LLM 调用出错: %s", e)
+        return {"answer": "抱歉，AI 大脑暂时短路了，请检查 API Key 或网络。", "mode": "error"}
+
+def rag_answer(query: str, top_k: int = 5, token_budget: int = PROMPT_TOKEN_BUDGET,
+               use_cache: bool = True) -> str:
+    """
+    RAG 流程
+    """
+    return answer_with_mode(query, top_k, token_budget, use_cache)["answer"]
 
 if __name__ == "__main__":
     # 本地测试
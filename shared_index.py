@@ -0,0 +1,281 @@
+# shared_index.py
+"""
+多 worker 部署用的共享索引。
+
+向量、chunk/doc 映射表和文档库都以 mmap 方式打开，多个 uvicorn worker 共用同一份
+page cache，不会每个进程在堆上各复制一份 FAISS 索引、docids.json 和 corpus 字典。
+
+开启：环境变量 CAMPUS_MMAP=1（WORKERS>1 启动 main.py 时会自动开启）
+导出：python shared_index.py --export        （build_dense_index 结束时也会自动导出）
+报告：python shared_index.py --report --workers 1,2,4
+"""
+import os
+import sys
+import json
+import mmap
+import argparse
+
+import faiss
+import numpy as np
+
+VECTORS_FILE = "vectors.npy"               # float32 (ntotal, dim)，faiss 不支持 mmap 打开 Flat 索引时使用
+CHUNK_NO_FILE = "chunk_no.npy"             # chunk 行号 -> chunk 序号
+DOC_IDS_NPY_FILE = "doc_ids.npy"           # 整数 doc id -> docid (定长字节串)
+DOC_IDS_SORTED_FILE = "doc_ids_sorted.npy" # 排序后的 docid，用于二分查找 docid -> 整数 id
+DOC_IDS_ORDER_FILE = "doc_ids_order.npy"   # 与上面对应的整数 doc id
+DOCSTORE_FILE = "docstore.bin"             # 按整数 doc id 顺序拼接的 JSON 记录 {"url", "contents"}
+DOCSTORE_OFFSETS_FILE = "docstore_offsets.npy"
+
+
+def mmap_enabled() -> bool:
+    return os.getenv("CAMPUS_MMAP", "0") == "1"
+
+
+# ========== 导出 ==========
+def export_shared_index(out_dir, chunk_ids, table, docs, vectors=None):
+    """
+    把建索引的结果导出成可 mmap 的格式。
+
+    :param chunk_ids: 与 FAISS 行号一一对应的 chunk id 列表
+    :param table: fusion.DocTable
+    :param docs: {docid: {"url", "contents"}}
+    :param vectors: 全部 chunk 向量 (ntotal, dim)，可选
+    """
+    from fusion import chunk_no
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, CHUNK_NO_FILE),
+            np.fromiter((chunk_no(c) for c in chunk_ids), dtype=np.int32, count=len(chunk_ids)))
+
+    encoded = np.array([d.encode("utf-8") for d in table.doc_ids], dtype=bytes)
+    order = np.argsort(encoded, kind="stable").astype(np.int64)
+    np.save(os.path.join(out_dir, DOC_IDS_NPY_FILE), encoded)
+    np.save(os.path.join(out_dir, DOC_IDS_SORTED_FILE), encoded[order])
+    np.save(os.path.join(out_dir, DOC_IDS_ORDER_FILE), order)
+
+    offsets = np.zeros(len(table.doc_ids) + 1, dtype=np.int64)
+    with open(os.path.join(out_dir, DOCSTORE_FILE), "wb") as f:
+        for i, d in enumerate(table.doc_ids):
+            page = docs.get(d, {})
+            rec = json.dumps({"url": page.get("url", ""), "contents": page.get("contents", "")},
+                             ensure_ascii=False).encode("utf-8")
+            f.write(rec)
+            offsets[i + 1] = offsets[i] + len(rec)
+    np.save(os.path.join(out_dir, DOCSTORE_OFFSETS_FILE), offsets)
+
+    if vectors is not None:
+        np.save(os.path.join(out_dir, VECTORS_FILE), np.ascontiguousarray(vectors, dtype=np.float32))
+
+
+def export_from_existing():
+    """把已有的 dense.index / docids.json / corpus.jsonl 转成共享格式（非 mmap 方式读取一次）"""
+    os.environ["CAMPUS_MMAP"] = "0"
+    import fusion
+    from dense_search import load_dense_index, load_corpus
+
+    index, chunk_ids = load_dense_index()
+    table = fusion.load_doc_table()
+    export_shared_index(fusion.DOC_TABLE_DIR, chunk_ids, table, load_corpus(),
+                        vectors=index.reconstruct_n(0, index.ntotal))
+    print(f"✅ 共享索引已导出到 {fusion.DOC_TABLE_DIR}")
+
+
+# ========== mmap 读取 ==========
+class MmapStrArray:
+    """定长字节串数组的只读视图，下标访问返回 str"""
+
+    def __init__(self, arr):
+        self._arr = arr
+
+    def __len__(self):
+        return len(self._arr)
+
+    def __getitem__(self, i):
+        return self._arr[i].decode("utf-8")
+
+
+class MmapDocTable:
+    """与 fusion.DocTable 接口一致，但全部数组 mmap 打开，docid -> 整数 id 用二分查找代替字典"""
+
+    def __init__(self, table_dir):
+        from fusion import CHUNK_DOC_FILE, DOC_URL_IDS_FILE
+
+        load = lambda name: np.load(os.path.join(table_dir, name), mmap_mode="r")
+        self.doc_ids = MmapStrArray(load(DOC_IDS_NPY_FILE))
+        self.chunk_doc = load(CHUNK_DOC_FILE)
+        self.url_ids = load(DOC_URL_IDS_FILE)
+        self._sorted = load(DOC_IDS_SORTED_FILE)
+        self._order = load(DOC_IDS_ORDER_FILE)
+
+    def to_int(self, docids):
+        """字符串 docid 列表 -> 整数 id 数组，未知 docid 记为 -1"""
+        if not docids or len(self._sorted) == 0:
+            return np.full(len(docids), -1, dtype=np.int64)
+        width = self._sorted.dtype.itemsize
+        raw = [d.encode("utf-8") for d in docids]
+        keys = np.array(raw, dtype=self._sorted.dtype)
+        pos = np.minimum(np.searchsorted(self._sorted, keys), len(self._sorted) - 1)
+        found = (self._sorted[pos] == keys) & np.array([len(r) <= width for r in raw])
+        return np.where(found, self._order[pos], -1).astype(np.int64)
+
+
+class MmapDocStore:
+    """mmap 文档库，提供与 corpus 字典相同的 get(docid, default)"""
+
+    def __init__(self, store_dir, table):
+        self._table = table
+        self._offsets = np.load(os.path.join(store_dir, DOCSTORE_OFFSETS_FILE), mmap_mode="r")
+        path = os.path.join(store_dir, DOCSTORE_FILE)
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def record(self, i):
+        return json.loads(self._mm[self._offsets[i]:self._offsets[i + 1]])
+
+    def get(self, docid, default=None):
+        i = self._table.to_int([docid])[0]
+        return self.record(i) if i >= 0 else default
+
+    def __contains__(self, docid):
+        return self._table.to_int([docid])[0] >= 0
+
+
+class ChunkIds:
+    """按需拼出 chunk id (doc123_chunk4)，代替常驻内存的 docids.json 列表"""
+
+    def __init__(self, table, chunk_no):
+        self._table = table
+        self._chunk_no = chunk_no
+
+    def __len__(self):
+        return len(self._chunk_no)
+
+    def __getitem__(self, row):
+        return f"{self._table.doc_ids[self._table.chunk_doc[row]]}_chunk{self._chunk_no[row]}"
+
+
+class MmapFlatIP:
+    """mmap 向量上的精确内积检索，search 接口与 faiss.IndexFlatIP 相同"""
+
+    def __init__(self, path):
+        self.xb = np.load(path, mmap_mode="r")
+        self.ntotal, self.d = self.xb.shape
+
+    def search(self, q, k):
+        k = min(k, self.ntotal)
+        scores = q @ self.xb.T
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        part = np.take_along_axis(scores, idx, axis=1)
+        order = np.argsort(-part, axis=1, kind="stable")
+        return (np.take_along_axis(part, order, axis=1).astype(np.float32),
+                np.take_along_axis(idx, order, axis=1).astype(np.int64))
+
+
+def open_dense_index(index_path, shared_dir):
+    """优先让 faiss 直接 mmap 打开 Flat 索引（新版本支持），否则退回 mmap 的 vectors.npy"""
+    if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        return faiss.read_index(index_path, faiss.IO_FLAG_MMAP_IFC)
+    return MmapFlatIP(os.path.join(shared_dir, VECTORS_FILE))
+
+
+def open_chunk_ids(shared_dir, table):
+    return ChunkIds(table, np.load(os.path.join(shared_dir, CHUNK_NO_FILE), mmap_mode="r"))
+
+
+# ========== 内存报告 ==========
+def process_memory(pid=None):
+    """
+    读取进程内存 (MB)。Linux 下用 smaps_rollup，给出 PSS（共享页按进程数均摊），
+    比 RSS 更能反映多进程共享后的真实占用。
+    """
+    path = f"/proc/{pid or 'self'}/smaps_rollup"
+    if os.path.exists(path):
+        fields = {}
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1]) / 1024
+        return {
+            "rss_mb": round(fields.get("Rss", 0), 1),
+            "pss_mb": round(fields.get("Pss", 0), 1),
+            "shared_mb": round(fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0), 1),
+            "private_mb": round(fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0), 1),
+        }
+
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {"rss_mb": round(rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024, 1)}
+
+
+def _report_worker(use_mmap, n_queries, ready, stop):
+    """模拟一个 worker：加载索引、映射表与文档库，跑若干次检索 + 取回原文"""
+    os.environ["CAMPUS_MMAP"] = "1" if use_mmap else "0"
+    from dense_search import load_dense_index, load_corpus
+    from fusion import load_doc_table
+
+    index, _ = load_dense_index()
+    table = load_doc_table()
+    corpus = load_corpus()
+    rng = np.random.default_rng(os.getpid())
+    for _ in range(n_queries):
+        # 用随机向量代替模型编码，只衡量索引相关的内存
+        q = rng.standard_normal((1, index.d)).astype(np.float32)
+        q /= np.linalg.norm(q)
+        _, idxs = index.search(q, 50)
+        for row in idxs[0]:
+            corpus.get(table.doc_ids[table.chunk_doc[row]])
+    ready.put(os.getpid())
+    stop.wait()
+
+
+def memory_report(worker_counts, n_queries=20, modes=("heap", "mmap")):
+    import multiprocessing as mp
+
+    ctx = mp.get_context("spawn")
+    rows = []
+    for mode in modes:
+        for n in worker_counts:
+            ready, stop = ctx.Queue(), ctx.Event()
+            procs = [ctx.Process(target=_report_worker, args=(mode == "mmap", n_queries, ready, stop))
+                     for _ in range(n)]
+            for p in procs:
+                p.start()
+            pids = [ready.get() for _ in procs]
+            mems = [process_memory(pid) for pid in pids]
+            stop.set()
+            for p in procs:
+                p.join()
+
+            row = {
+                "mode": mode,
+                "workers": n,
+                "rss_per_worker_mb": round(sum(m["rss_mb"] for m in mems) / n, 1),
+                "total_rss_mb": round(sum(m["rss_mb"] for m in mems), 1),
+            }
+            if "pss_mb" in mems[0]:
+                row["total_pss_mb"] = round(sum(m["pss_mb"] for m in mems), 1)
+                row["private_per_worker_mb"] = round(sum(m["private_mb"] for m in mems) / n, 1)
+            rows.append(row)
+            print(json.dumps(row, ensure_ascii=False))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="多 worker 共享索引：导出与内存报告")
+    parser.add_argument("--export", action="store_true", help="把现有索引导出为可 mmap 的格式")
+    parser.add_argument("--report", action="store_true", help="按 worker 数统计每个进程的内存占用")
+    parser.add_argument("--workers", default="1,2,4", help="逗号分隔的 worker 数")
+    parser.add_argument("--modes", default="heap,mmap", help="对比的加载方式：heap（原方式）/ mmap")
+    args = parser.parse_args()
+
+    if args.export:
+        export_from_existing()
+    if args.report:
+        print("📊 多 worker 内存报告（PSS 为共享页均摊后的真实占用，total_pss 不随 worker 数线性增长即说明共享生效）")
+        memory_report([int(n) for n in args.workers.split(",")], modes=tuple(args.modes.split(",")))
+    if not (args.export or args.report):
+        parser.print_help()
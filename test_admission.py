@@ -0,0 +1,58 @@
+# test_admission.py
+"""
+准入控制的并发行为：释放某阶段的槽位时，排队等该阶段的请求应立即拿到槽位，
+不会被排在前面的其他阶段的等待者“吞掉”唤醒而空等到超时。
+
+运行：python -m pytest -q test_admission.py
+"""
+import time
+import threading
+
+from admission import AdmissionController
+
+WAIT = 2.0          # 等待者的最长排队时间；被正确唤醒时远小于它
+PROMPT = 0.2        # 视为“立即准入”的上限
+
+
+def _queue_waiter(ctrl, stage, results):
+    """在后台线程里排队占用 stage 槽位，记录是否成功与排队耗时"""
+    def run():
+        start = time.perf_counter()
+        ok = ctrl.acquire(stage, wait=WAIT)
+        results[stage] = (ok, time.perf_counter() - start)
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    time.sleep(0.05)    # 确保该线程已进入等待
+    return t
+
+
+def _release_with_other_stage_queued(freed, other):
+    ctrl = AdmissionController({"retrieval": 1, "rerank": 1, "generation": 1, "batch": 1})
+    assert ctrl.acquire(freed) and ctrl.acquire(other)
+
+    results = {}
+    # 另一阶段的等待者先排队，被释放阶段的等待者后排队
+    threads = [_queue_waiter(ctrl, other, results), _queue_waiter(ctrl, freed, results)]
+    ctrl.release(freed)
+    threads[1].join(WAIT + 1)
+
+    ok, waited = results[freed]
+    assert ok
+    assert waited < PROMPT + 0.05, f"{freed} 等待者在槽位释放后仍等了 {waited:.2f}s"
+    assert other not in results, f"{other} 等待者不应拿到 {freed} 释放的槽位"
+
+    ctrl.release(other)
+    threads[0].join(WAIT + 1)
+    assert results[other][0]
+
+
+def test_retrieval_release_wakes_retrieval_waiter():
+    _release_with_other_stage_queued("retrieval", "rerank")
+
+
+def test_rerank_release_wakes_rerank_waiter():
+    _release_with_other_stage_queued("rerank", "retrieval")
+
+
+def test_generation_release_wakes_generation_waiter():
+    _release_with_other_stage_queued("generation", "retrieval")
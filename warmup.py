@@ -0,0 +1,144 @@
+# warmup.py
+"""
+服务启动预热与就绪状态。
+
+main.py 启动时不再在 import 阶段加载 pyserini (JVM) / 编码模型 / FAISS / DeepSeek 客户端，
+而是先绑定端口，再由后台线程依次加载各组件，并对每条检索路径跑一次假查询，
+把首个真实请求要付出的懒加载开销提前付掉。
+
+- /healthz ：进程存活即返回 200
+- /ready   ：所有必需组件加载完成才返回 200，否则 503；附带每个组件的状态与加载耗时
+
+滚动重启时负载均衡以 /ready 作为就绪探针，冷启动中的 worker 不会接到流量。
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from metrics import Gauge
+
+WARMUP_QUERY = "中国人民大学"
+# 请求在组件未就绪时最多等待的秒数，超时返回 503
+WARMUP_WAIT = float(os.getenv("CAMPUS_WARMUP_WAIT", "5"))
+
+COMPONENT_LOAD_SECONDS = Gauge("campus_component_load_seconds", "各组件启动预热耗时", ["component"])
+COMPONENT_READY = Gauge("campus_component_ready", "组件是否已就绪 (1/0)", ["component"])
+
+logger = logging.getLogger(__name__)
+
+
+# ========== 各组件的加载 + 假查询 ==========
+def _warm_bm25():
+    from bm_search import get_searcher, bm25_docids
+    get_searcher()
+    bm25_docids(WARMUP_QUERY, 10)
+
+
+def _warm_dense():
+    from dense_search import load_model, load_dense_index, load_corpus, dense_chunk_search
+    load_dense_index()
+    load_corpus()
+    load_model()
+    dense_chunk_search(WARMUP_QUERY, 10)
+
+
+def _warm_hybrid():
+    from hybrid_search import hybrid_search
+    hybrid_search(WARMUP_QUERY, top_k=5)
+
+
+def _warm_answer_cache():
+    from answer_cache import get_answer_cache
+    get_answer_cache()
+
+
+def _warm_llm():
+    """创建 DeepSeek 客户端并构造一次重排 / 问答提示词；不发起真实 API 调用"""
+    import llm_rerank
+    import rag_qa
+    from hybrid_search import hybrid_search
+    llm_rerank.get_client()
+    rag_qa.get_client()
+    hits = hybrid_search(WARMUP_QUERY, top_k=5, with_passages=True)
+    llm_rerank._build_rerank_prompt(WARMUP_QUERY, hits)
+    rag_qa.build_prompt(WARMUP_QUERY, hits)
+
+
+# (组件名, 预热函数, 是否必需)。LLM 依赖外部 API Key，缺失时只影响 use_llm / /ask，不阻塞就绪
+COMPONENTS = [
+    ("bm25", _warm_bm25, True),
+    ("dense", _warm_dense, True),
+    ("hybrid", _warm_hybrid, True),
+    ("answer_cache", _warm_answer_cache, True),
+    ("llm", _warm_llm, False),
+]
+
+
+class Readiness:
+    def __init__(self, components=COMPONENTS):
+        self.components = components
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        self._state = OrderedDict(
+            (name, {"status": "pending", "required": required, "load_s": None, "error": None})
+            for name, _, required in components
+        )
+
+    def start(self):
+        """启动后台预热线程（重复调用无效）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        logger.info("🔥 [Warmup] 开始后台预热: %s", ", ".join(name for name, _, _ in self.components))
+        for name, fn, required in self.components:
+            with self._lock:
+                self._state[name]["status"] = "loading"
+            start = time.perf_counter()
+            try:
+                fn()
+                status, error = "ready", None
+            except Exception as e:
+                if required:
+                    logger.exception("❌ [Warmup] 组件 %s 加载失败", name)
+                else:
+                    logger.warning("⚠️ [Warmup] 可选组件 %s 加载失败: %s", name, e)
+                status, error = "failed", str(e)
+            elapsed = round(time.perf_counter() - start, 3)
+            with self._lock:
+                self._state[name].update(status=status, load_s=elapsed, error=error)
+            COMPONENT_LOAD_SECONDS.set(elapsed, component=name)
+            COMPONENT_READY.set(1 if status == "ready" else 0, component=name)
+            logger.info("🔥 [Warmup] %s %s，耗时 %.2fs", name, status, elapsed)
+
+            if self.is_ready():
+                self._ready.set()
+
+        logger.info("✅ [Warmup] 预热结束，就绪: %s（启动后 %.1fs）", self.is_ready(), time.time() - self.started)
+
+    def is_ready(self) -> bool:
+        with self._lock:
+            return all(s["status"] == "ready" for s in self._state.values() if s["required"])
+
+    def wait(self, timeout: float = WARMUP_WAIT) -> bool:
+        """等待必需组件就绪，超时返回 False"""
+        return self._ready.wait(timeout)
+
+    def snapshot(self):
+        with self._lock:
+            components = {name: dict(s) for name, s in self._state.items()}
+        return {
+            "ready": self.is_ready(),
+            "uptime_s": round(time.time() - self.started, 1),
+            "components": components,
+        }
+
+
+READINESS = Readiness()